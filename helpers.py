@@ -1,20 +1,98 @@
 import os
+import re
 import sys
 import csv
+import gzip
 import json
-import subprocess
+import time
+import random
+import sqlite3
+import hashlib
+import threading
 
+from collections import deque, Counter
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from datetime import datetime, date
+from time import perf_counter
 
 from pathlib import Path
 from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
 
+import click
+import ckanapi
+import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
+import shapely
 from shapely import from_geojson, to_geojson
-from shapely.geometry import shape, mapping, MultiPolygon, Polygon
+from shapely.geometry import MultiPolygon, Polygon
 from shapely.ops import unary_union
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def snapshot(ctx,dest):
+# Number of datasets requested per package_search page
+PAGE_SIZE = 1000
+
+# Default number of concurrent API calls for per-resource work
+CONCURRENCY = 8
+
+# Seconds to wait for a connection to CKAN, and for a response to each API call
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+
+# Times an idempotent API call is retried when CKAN is overloaded or unreachable
+RETRIES = 5
+
+# Seconds before the first retry and at most between retries, before jitter
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30
+
+# Bump when simplify_to_size output changes, to invalidate SimplifyCache entries
+SIMPLIFY_VERSION = 1
+
+# Fields fetched by the list commands
+LIST_FIELDS = ['id', 'name', 'title']
+
+# Core package fields stored in CKAN's Solr index with the same value as in
+# package_show, so they can be requested with fl. Other fields (scheming
+# fields, organization, resources, ...) are not stored or come back in a
+# different shape, and are projected from full datasets instead.
+STORED_FIELDS = {
+    'id', 'name', 'title', 'notes', 'url', 'version', 'state', 'type', 'private',
+    'owner_org', 'author', 'author_email', 'maintainer', 'maintainer_email',
+    'license_id', 'creator_user_id', 'metadata_created', 'metadata_modified',
+}
+
+# Gazetteer fields package_patch must always receive together
+SPATIAL_FIELDS = ('spatial_full', 'spatial_simp')
+
+# Package types copied to the local mirror by sync
+MIRROR_TYPES = ['dataset', 'application']
+
+# Datasets parsed per vectorized batch by spatial_stats --extended
+STATS_CHUNK = 200
+
+# Characters encoded at a time by utf8_len for non-ASCII text
+UTF8_CHUNK = 1 << 20
+
+# Characters read at a time when streaming a .json snapshot
+JSON_CHUNK = 1 << 20
+
+# File suffix for each snapshot compression option
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+    'none': '',
+}
+
+
+def snapshot(ctx,dest,incremental=False,compression='gzip'):
 
     twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
@@ -23,8 +101,13 @@ def snapshot(ctx,dest):
         logecho('Destination directory {} not found'.format(dest), level='error')
         sys.exit()
 
+    if compression == 'zstd' and zstandard is None:
+        logecho('zstd compression requires the zstandard package', level='error')
+        sys.exit(1)
+
     try:
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        started = datetime.now()
+        timestamp = started.strftime("%Y-%m-%d_%H-%M-%S")
         parsed_address = urlparse(twdh.address)
         logecho( parsed_address.netloc )
         snap_dest = "{}/{}_{}".format( dest, parsed_address.netloc, timestamp )
@@ -35,298 +118,1975 @@ def snapshot(ctx,dest):
         sys.exit(1)
 
     ##########################################
-    # Create spatial stats report
+    # The manifest.json of every snapshot
+    # records where each package's dataset
+    # and resource records are in its files.
+    # An incremental snapshot only asks CKAN
+    # for datasets modified since the
+    # previous snapshot and copies the rest
+    # from the previous snapshot's files,
+    # which are read in the same id order.
+    # Records that cannot be read from there
+    # are fetched from CKAN again.
     ##########################################
-    spatial_stats( ctx, [], '{}/spatial-stats.csv'.format( snap_dest ), True )
+    previous = None
+    if incremental:
+        previous = load_manifest( dest, parsed_address.netloc )
+        if previous:
+            logecho( 'Incremental snapshot, changes since {}'.format(previous['snapshot']), 'info' )
+        else:
+            logecho( 'No previous snapshot manifest found, taking a full snapshot', 'warning' )
+
+    def previous_records(name):
+        # Reader of the previous snapshot's file name.jsonl, whatever its compression
+        if not previous:
+            return PreviousRecords(None)
+        file_name = next((f for f in previous['files'] if f.startswith(name + '.jsonl')), None)
+        return PreviousRecords(os.path.join(dest, previous['snapshot'], file_name) if file_name else None)
+
+    manifest = {
+        'host': twdh.address,
+        'snapshot': os.path.basename(snap_dest),
+        'incremental_from': previous['snapshot'] if previous else None,
+        'compression': compression,
+        'started': started.isoformat(),
+        'files': {},
+        'timings': {},
+        'packages': {},
+    }
 
     ##########################################
-    # Create human readable dataset and 
-    # application backups
+    # Fetch the catalog once per dataset type
+    # and fan every dataset out to the stages
+    # that need it:
+    # - JSONL backups of datasets and
+    #   applications (datasets.jsonl.gz,
+    #   applications.jsonl.gz)
+    # - spatial stats report
+    # - resource 'data dictionary' and 'views'
+    #   backups. These calls are made per
+    #   resource, several at a time; failed
+    #   calls are recorded in errors.jsonl
+    # All JSONL files are streamed through the
+    # chosen compression as they are written.
     ##########################################
     dataset_types = [ 'dataset', 'application' ]
+    errors = []
+    stats = SpatialStats( ctx, '{}/spatial-stats.csv'.format( snap_dest ), True )
+    stage_start = perf_counter()
 
-    for dataset_type in dataset_types:
-        dataset_file = '{}/{}s.json'.format(snap_dest, dataset_type) 
-        results = twdh.action.package_search(
-            rows=100000,
-            fq="type:{}".format(dataset_type),
-            include_deleted=True,
-            include_drafts=True,
-            include_private=True
-        )
-        try:
-            with open(dataset_file, 'w') as json_file:
-                json.dump(results, json_file, indent=4) #
-            logecho( 'Created snapshot file: {}'.format(dataset_file), 'info' )
+    try:
+        with RecordWriter('{}/data-dicts.jsonl'.format(snap_dest), compression) as dd_out, \
+                RecordWriter('{}/resource-views.jsonl'.format(snap_dest), compression) as v_out:
 
-        except FileNotFoundError:
-            logecho( "Unable to write JSON / Destination not found error", 'error' )
-            sys.exit(1)
-        except Exception as e:
-            logecho( "An unexpected error occurred, unable to write JSON: {}".format(e), 'error' )
-            sys.exit(1)
+            resource_outputs = {
+                'data_dictionary_show': dd_out,
+                'resource_view_list': v_out,
+            }
+            resource_previous = {
+                'data_dictionary_show': previous_records('data-dicts'),
+                'resource_view_list': previous_records('resource-views'),
+            }
 
-    ##########################################
-    # Create resource 'data dictionary' backup
-    ##########################################
-    dd_file = '{}/data-dicts.jsonl'.format(snap_dest) 
-    results = twdh.action.package_search(
-        rows=100000,
-        fq="type:dataset",
-        include_deleted=True,
-        include_drafts=True,
-        include_private=True
-    )
-    try:
-        with open(dd_file, 'w') as json_file:
-            for dataset in results['results']:
-                if "resources" in dataset:
-                    for resource in dataset['resources']:
-                        dd = twdh.action.data_dictionary_show( id=resource['id'] )
-                        if len(dd) > 0:
-                            json_file.write(json.dumps(dd) + '\n')
+            for dataset_type in dataset_types:
+                with RecordWriter('{}/{}s.jsonl'.format(snap_dest, dataset_type), compression) as dataset_out, \
+                        previous_records('{}s'.format(dataset_type)) as dataset_previous:
 
-        logecho( 'Created snapshot file: {}'.format(dd_file), 'info' )
+                    def fan_out():
+                        for dataset, entry in snapshot_datasets(ctx, dataset_type, previous, dataset_previous):
+                            manifest['packages'][dataset['id']] = {
+                                'type': dataset_type,
+                                'metadata_modified': dataset.get('metadata_modified'),
+                                'record': dataset_out.records,
+                            }
+                            dataset_out.write_json(json.dumps(dataset, sort_keys=True, separators=(',', ':')))
 
-    except FileNotFoundError:
-        logecho( "Unable to write JSON / Destination not found error", 'error' )
-        sys.exit(1)
-    except Exception as e:
-        logecho( "An unexpected error occurred: {}".format(e), 'error' )
-        sys.exit(1)
+                            if dataset_type != 'dataset':
+                                continue
+                            if dataset.get('state') != 'deleted':
+                                stats.add(dataset)
 
+                            # Unchanged since the previous snapshot: copy its resource records
+                            reused = entry and {
+                                action: resource_previous[action].read(*entry.get(action, [0, 0]))
+                                if isinstance(entry.get(action, []), list) else None
+                                for action in resource_outputs
+                            }
+                            if reused and all(records is not None for records in reused.values()):
+                                for action, records in reused.items():
+                                    if records:
+                                        yield dataset['id'], action, None, records
+                            else:
+                                for resource in dataset.get('resources', []):
+                                    for action in resource_outputs:
+                                        yield dataset['id'], action, resource['id'], None
 
+                    backup_resource_records(ctx, fan_out(), resource_outputs, errors, manifest)
 
-    ##########################################
-    # Create resource 'views' backup
-    ##########################################
-    v_file = '{}/resource-views.jsonl'.format(snap_dest) 
-    results = twdh.action.package_search(
-        rows=100000,
-        fq="type:dataset",
-        include_deleted=True,
-        include_drafts=True,
-        include_private=True
-    )
-    try:
-        with open(v_file, 'w') as json_file:
-            for dataset in results['results']:
-                if "resources" in dataset:
-                    for resource in dataset['resources']:
-                        views = twdh.action.resource_view_list( id=resource['id'] )
-                        if len(views) > 0:
-                            json_file.write(json.dumps(views) + '\n')
+                manifest['files'][os.path.basename(dataset_out.path)] = dataset_out.stats
+                logecho( 'Created snapshot file: {}'.format(dataset_out.path), 'info' )
 
-        logecho( 'Created snapshot file: {}'.format(v_file), 'info' )
+        for out in resource_outputs.values():
+            manifest['files'][os.path.basename(out.path)] = out.stats
+            logecho( 'Created snapshot file: {}'.format(out.path), 'info' )
+        for reader in resource_previous.values():
+            reader.close()
+
+        stats.close()
 
     except FileNotFoundError:
         logecho( "Unable to write JSON / Destination not found error", 'error' )
         sys.exit(1)
     except Exception as e:
-        logecho( "An unexpected error occurred: {}".format(e), 'error' )
-        #sys.exit(1)
+        logecho( "An unexpected error occurred, unable to write JSON: {}".format(e), 'error' )
+        sys.exit(1)
+
+    manifest['timings']['catalog'] = round(perf_counter() - stage_start, 3)
 
     ##########################################
-    # Create JSONL backups of datasets, 
-    # applications, organizations, users. 
-    # Datasets include type 'dataset' and 
-    # 'application' all in the same file.
+    # Create JSONL backups of groups,
+    # organizations and users. The three
+    # types are dumped at the same time over
+    # the existing CKAN session.
     ##########################################
     obj_types = [ 
-        'datasets', 
         'groups', 
         'organizations', 
         'users'
     ]
-    for obj_type in obj_types:
-        obj_file = '{}/{}.jsonl'.format(snap_dest, obj_type)
-        try:
+    stage_start = perf_counter()
+    logecho( 'Dumping {}...'.format(', '.join(obj_types)), 'info' )
 
-            command = "ckanapi dump {obj_type} --apikey={apikey} --all -O {obj_file} -r {url}".format( \
-                obj_type=obj_type, \
-                apikey=twdh.apikey, \
-                obj_file=obj_file, \
-                url=twdh.address \
+    with ThreadPoolExecutor(max_workers=len(obj_types)) as executor:
+        dumps = {
+            obj_type: executor.submit(
+                dump_objects, ctx, obj_type, '{}/{}.jsonl'.format(snap_dest, obj_type), compression, errors
             )
+            for obj_type in obj_types
+        }
 
-            #logecho( command, 'info' )
-            logecho( 'Dumping {}...\n'.format(obj_type), 'info' )
-            output = subprocess.getoutput(command)
-            logecho( output, 'info' )
-            logecho( 'Created snapshot file: {}'.format(obj_file), 'info' )
-
+    for obj_type, dump in dumps.items():
+        try:
+            obj_stats = dump.result()
 
         except FileNotFoundError:
             logecho( "Unable to write JSONL / Destination not found error", 'error' )
             sys.exit(1)
         except Exception as e:
-            logecho( "An error occurred: {}".format(e), 'error' )
+            logecho( "An error occurred dumping {}: {}".format(obj_type, e), 'error' )
             sys.exit(1)
 
+        obj_file = '{}/{}.jsonl{}'.format(snap_dest, obj_type, COMPRESSION_SUFFIXES[compression])
+        manifest['files'][os.path.basename(obj_file)] = obj_stats
+        logecho( 'Dumped {} {} to {}'.format(obj_stats['records'], obj_type, obj_file), 'info' )
+
+    failed = {}
+    for error in errors:
+        failed[error['action']] = failed.get(error['action'], 0) + 1
+
+    if errors:
+        errors_file = '{}/errors.jsonl'.format(snap_dest)
+        with open(errors_file, 'w') as json_file:
+            for error in errors:
+                json_file.write(json.dumps(error) + '\n')
+        for action, count in failed.items():
+            logecho( '{} {} calls failed'.format(count, action), 'warning' )
+        logecho( 'Failed calls are listed in {}'.format(errors_file), 'warning' )
+
+    manifest['timings']['dumps'] = round(perf_counter() - stage_start, 3)
+
+    ##########################################
+    # Write the manifest last, so a snapshot
+    # without one is known to be incomplete
+    ##########################################
+    finished = datetime.now()
+    manifest['finished'] = finished.isoformat()
+    manifest['timings']['total'] = round((finished - started).total_seconds(), 3)
+
+    manifest_file = '{}/manifest.json'.format(snap_dest)
+    with open(manifest_file, 'w') as json_file:
+        json.dump(manifest, json_file)
+    logecho( 'Created snapshot file: {}'.format(manifest_file), 'info' )
 
-        logecho("Successfully dumped datasets to {}".format(obj_file), 'info')
-    
     logecho("Snapshot complete!", 'celebration')
 
 
-def spatial_stats(ctx, ids, csvout, quiet):
+def dump_objects(ctx, obj_type, path, compression, errors):
+    """
+    Dump every group, organization or user to a JSONL RecordWriter at
+    path, the way 'ckanapi dump' does, and return the writer's stats.
+    Each object is fetched with its _show action, ctx.obj['concurrency']
+    at a time; users include their password hash so logins can be
+    restored. Failed calls are appended to errors instead of raised.
+    """
 
     twdh = ctx.obj['twdh']
-    logecho = ctx.obj['logecho']
+    concurrency = ctx.obj.get('concurrency') or CONCURRENCY
+
+    thing = obj_type[:-1]
+    show = getattr(twdh.action, '{}_show'.format(thing))
+
+    if obj_type == 'users':
+        names = [user['name'] for user in twdh.action.user_list()]
+
+        def call(name):
+            return show( id=name, include_password_hash=True )
+
+    else:
+        names = getattr(twdh.action, '{}_list'.format(thing))()
+
+        def call(name):
+            return show( id=name, include_datasets=False, include_users=True, include_extras=True )
+
+    with RecordWriter(path, compression) as out:
+        for name, future in bounded_map(call, names, concurrency):
+            try:
+                out.write(future.result())
+            except Exception as e:
+                errors.append({'action': '{}_show'.format(thing), 'id': name, 'error': str(e)})
+
+    return out.stats
+
+
+class RecordWriter:
+    """
+    Stream records to a JSONL file, one compact JSON document per line,
+    through gzip, zstd or no compression. The compression suffix is added
+    to path. Once closed, stats holds the record count, the uncompressed
+    and on-disk byte sizes, the sha256 of the file and the seconds it was
+    open, for the snapshot manifest.
+    """
+
+    def __init__(self, path, compression='gzip'):
+        self.path = path + COMPRESSION_SUFFIXES[compression]
+        self.stats = None
+        self.records = 0
+        self.raw_bytes = 0
+        self.started = perf_counter()
+
+        self._file = open(self.path, 'wb')
+        self._hashing = _HashingWriter(self._file)
+        if compression == 'gzip':
+            self._stream = gzip.GzipFile(fileobj=self._hashing, mode='wb')
+        elif compression == 'zstd':
+            self._stream = zstandard.ZstdCompressor().stream_writer(self._hashing, closefd=False)
+        else:
+            self._stream = self._hashing
+
+    def write(self, record):
+        self.write_json(json.dumps(record, separators=(',', ':')))
+
+    def write_json(self, text):
+        data = text.encode('utf-8') + b'\n'
+        self._stream.write(data)
+        self.records += 1
+        self.raw_bytes += len(data)
+
+    def close(self):
+        if self.stats is not None:
+            return
+        if self._stream is not self._hashing:
+            self._stream.close()
+        self._file.close()
+        self.stats = {
+            'records': self.records,
+            'raw_bytes': self.raw_bytes,
+            'bytes': self._hashing.bytes,
+            'sha256': self._hashing.sha256.hexdigest(),
+            'seconds': round(perf_counter() - self.started, 3),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _HashingWriter:
+    """Minimal binary file wrapper that hashes and counts what is written"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def open_records(path):
+    """Open a snapshot file for reading as text, decompressing by suffix"""
+
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('Reading {} requires the zstandard package'.format(path))
+        return zstandard.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
 
-    datasets = fetch_datasets(ctx, ids)
 
-    dataset_count = 0
-    spatial_dataset_count = 0
-    nonspatial_dataset_count = 0
-    spatial_full_total = 0
-    spatial_simp_total = 0
+def read_records(path, ids=None):
+    """
+    Yield the records of a snapshot file: either a package_search style
+    .json document (older snapshots) or JSONL, optionally compressed. Both
+    are read one record at a time. With ids (a list of ids or names) only
+    the matching records are yielded.
+    """
+
+    def wanted(record):
+        return not ids or record.get('id') in ids or record.get('name') in ids
+
+    with open_records(path) as f:
+        if path.endswith(('.json', '.json.gz', '.json.zst')):
+            records = iter_json_array(f, 'results')
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+
+        for record in records:
+            if wanted(record):
+                yield record
+
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_DELIMITERS = ',]}: \t\n\r'
+
+
+def iter_json_array(text_file, key):
+    """
+    Yield the items of the array under key in the JSON object in text_file
+    one at a time, reading JSON_CHUNK characters at a time, so the whole
+    document is never in memory. The other top-level values are decoded
+    and discarded. Raises json.JSONDecodeError for malformed documents.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    # Characters and lines read and dropped from the buffer, and where the
+    # last of those lines ends, for error positions in the whole document
+    offset = lines = line_start = 0
+
+    def read_more():
+        nonlocal buffer, pos, eof, offset, lines, line_start
+        # Read at least as much again as is buffered, so a value spanning
+        # many chunks is decoded a bounded number of times
+        chunk = text_file.read(max(JSON_CHUNK, len(buffer) - pos))
+        eof = not chunk
+        dropped = buffer[:pos]
+        lines += dropped.count('\n')
+        if '\n' in dropped:
+            line_start = offset + dropped.rfind('\n') + 1
+        offset += pos
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+    def error(message, at):
+        # json.JSONDecodeError positioned in the document, not the buffer
+        e = json.JSONDecodeError(message, buffer, at)
+        last_newline = buffer.rfind('\n', 0, at)
+        e.pos = offset + at
+        e.lineno = lines + buffer.count('\n', 0, at) + 1
+        e.colno = at - last_newline if last_newline >= 0 else e.pos - line_start + 1
+        e.args = ('{}: line {} column {} (char {})'.format(message, e.lineno, e.colno, e.pos),)
+        return e
+
+    def next_char():
+        nonlocal pos
+        while True:
+            pos = JSON_WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if eof:
+                raise error('Unexpected end of document', pos)
+            read_more()
+
+    def expect(chars):
+        nonlocal pos
+        char = next_char()
+        if char not in chars:
+            raise error('Expected one of {!r}'.format(chars), pos)
+        pos += 1
+        return char
+
+    def decode_value():
+        nonlocal pos
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # A number at the end of the buffer, or cut short before a
+                # '.', 'e' or digit in the next chunk, may continue there:
+                # only a delimiter after the value shows that it is complete
+                if eof or (end < len(buffer) and buffer[end] in JSON_DELIMITERS):
+                    pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise error(e.msg, e.pos)
+            read_more()
+
+    expect('{')
+    while True:
+        if next_char() == '}':
+            break
+        name = decode_value()
+        expect(':')
+        if name != key:
+            decode_value()
+        else:
+            expect('[')
+            if next_char() == ']':
+                return
+            while True:
+                yield decode_value()
+                if expect(',]') == ']':
+                    return
+        if expect(',}') == '}':
+            break
+
+    raise error('No "{}" array found'.format(key), pos)
+
+
+def backup_resource_records(ctx, calls, outputs, errors, manifest):
+    """
+    Make resource-level calls (data_dictionary_show, resource_view_list),
+    ctx.obj['concurrency'] at a time, and write the non-empty results to
+    the RecordWriter outputs[action], in the order of calls.
+
+    calls yields (package_id, action, resource_id, records) tuples grouped
+    by package and may be lazy. When records is set they are the package's
+    records for that action, copied from the previous snapshot instead of
+    calling CKAN. The [first line, count] of each package's records in
+    every output is kept in its manifest entry. Failed calls are appended
+    to errors instead of raised, and their package is marked to be fetched
+    again next time.
+    """
+
+    twdh = ctx.obj['twdh']
+    concurrency = ctx.obj.get('concurrency') or CONCURRENCY
+
+    def call(item):
+        package_id, action, resource_id, records = item
+        if records is not None:
+            return records
+        return getattr(twdh.action, action)( id=resource_id )
+
+    def store(package_id, starts):
+        entry = manifest['packages'][package_id]
+        for action, out in outputs.items():
+            entry[action] = [starts[action], out.records - starts[action]]
+
+    package_id = None
+    starts = {}
+
+    for item, future in bounded_map(call, calls, concurrency):
+        if item[0] != package_id:
+            if package_id:
+                store(package_id, starts)
+            package_id = item[0]
+            starts = {action: out.records for action, out in outputs.items()}
+
+        item_package_id, action, resource_id, reused = item
+        try:
+            result = future.result()
+        except Exception as e:
+            errors.append({'action': action, 'id': resource_id, 'error': str(e)})
+            manifest['packages'][package_id]['metadata_modified'] = None
+            continue
+
+        records = result if reused is not None else [result] if len(result) > 0 else []
+        for record in records:
+            outputs[action].write(record)
+
+    if package_id:
+        store(package_id, starts)
+
+
+def snapshot_datasets(ctx, dataset_type, previous=None, previous_records=None):
+    """
+    Yield (dataset, entry) pairs for every dataset of dataset_type,
+    including deleted ones, sorted by id.
+
+    Without a previous manifest every dataset is fetched and entry is None.
+    With one, a light id/metadata_modified listing decides which datasets
+    changed; only those are fetched (with a metadata_modified query) and
+    the unchanged ones are read from the previous snapshot's file through
+    the PreviousRecords previous_records, with entry set to their previous
+    manifest entry. Those that cannot be read from it are fetched.
+    """
+
+    twdh = ctx.obj['twdh']
+
+    if not previous:
+        for dataset in iter_datasets(ctx, package_type=dataset_type, include_deleted=True):
+            yield dataset, None
+        return
+
+    known = previous['packages']
+    since = max(
+        (entry['metadata_modified'] for entry in known.values()
+            if entry['type'] == dataset_type and entry['metadata_modified']),
+        default=None
+    )
+
+    listing = iter_datasets(ctx, package_type=dataset_type, include_deleted=True,
+                            fl=['id', 'metadata_modified'])
+    changed = iter_datasets(ctx, package_type=dataset_type, include_deleted=True,
+                            fq_list=['metadata_modified:[{}Z TO *]'.format(since)] if since else [])
+
+    # Both streams are sorted by id, so they can be walked side by side
+    fresh = next(changed, None)
+    for listed in listing:
+        while fresh is not None and fresh['id'] < listed['id']:
+            fresh = next(changed, None)
+
+        if fresh is not None and fresh['id'] == listed['id']:
+            yield fresh, None
+            continue
+
+        entry = known.get(listed['id'])
+        if entry and same_modified(entry['metadata_modified'], listed['metadata_modified']) \
+                and isinstance(entry.get('record'), int):
+            records = previous_records.read(entry['record'], 1)
+            if records and records[0].get('id') == listed['id']:
+                yield records[0], entry
+                continue
+
+        # Modified while we were listing, or missing from the previous snapshot
+        yield twdh.action.package_show( id=listed['id'] ), None
+
+
+def parse_modified(value):
+    """
+    metadata_modified as a datetime truncated to milliseconds. Package
+    dicts carry microseconds ('...:56.789012') while fl listings return the
+    Solr stored field ('...:56.789Z'), so both are reduced to what Solr keeps.
+    """
+
+    if not value:
+        return None
+    whole, _, fraction = value.rstrip('Z').partition('.')
+    parsed = datetime.strptime(whole, '%Y-%m-%dT%H:%M:%S')
+    return parsed.replace(microsecond=int(fraction[:3].ljust(3, '0')) * 1000)
+
+
+def same_modified(a, b):
+    """Whether two metadata_modified values name the same moment, see parse_modified"""
+
+    return a is not None and b is not None and parse_modified(a) == parse_modified(b)
+
+
+def load_manifest(dest, netloc):
+    """Manifest of the most recent snapshot of host netloc in dest, or None"""
+
+    snapshots = sorted(
+        (name for name in os.listdir(dest) if name.startswith(netloc + '_')),
+        reverse=True
+    )
+    for name in snapshots:
+        manifest_file = os.path.join(dest, name, 'manifest.json')
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as json_file:
+                return json.load(json_file)
+
+    return None
+
+
+class PreviousRecords:
+    """
+    Forward-only reader of a JSONL file of the previous snapshot, for
+    copying the records of unchanged packages. Records are asked for by
+    line in increasing order, the order snapshots are written in. Once
+    the file is missing, unreadable or already past a line, read returns
+    None and the caller fetches the records from CKAN instead.
+    """
+
+    def __init__(self, path):
+        self.file = None
+        self.line = 0
+        if path and os.path.exists(path):
+            try:
+                self.file = open_records(path)
+            except Exception:
+                self.file = None
+
+    def read(self, start, count):
+        """The records on lines start to start + count - 1, or None"""
+
+        if count == 0:
+            return []
+        if self.file is None or start < self.line:
+            return None
+
+        try:
+            while self.line < start:
+                if not self.file.readline():
+                    raise EOFError
+                self.line += 1
+
+            records = []
+            for _ in range(count):
+                text = self.file.readline()
+                if not text:
+                    raise EOFError
+                self.line += 1
+                records.append(json.loads(text))
+            return records
+
+        except Exception:
+            # Truncated or corrupt: fetch everything from here on
+            self.close()
+            return None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def spatial_stats(ctx, ids, csvout, quiet, extended=False):
+
+    stats = SpatialStats(ctx, csvout, quiet, extended)
+
+    logecho = ctx.obj['logecho']
+    logecho( "", "divider" )
+
+    for dataset in fetch_datasets(ctx, ids):
+        stats.add(dataset)
 
     logecho( "", "divider" )
+    stats.close()
+
+
+class SpatialStats:
+    """
+    Spatial size report fed one dataset at a time with add(), so it can
+    be one of several consumers of a single catalog fetch. Rows are
+    written to the CSV as they are added; close() logs the totals and
+    appends them to the CSV as # footer lines.
+
+    In extended mode, rows are held back in batches of STATS_CHUNK
+    datasets whose geometries are parsed into Shapely arrays, so vertex
+    and part counts, bounds, area, validity and the Hausdorff distance
+    between spatial_full and spatial_simp are computed with vectorized
+    calls. The summary then also has percentiles of those metrics.
+    """
 
-    csvdata = [['id','name','spatial_full_size','spatial_simp_size','spatial_simp_reduction']]
-    for dataset in datasets:
-        dataset_count += 1
+    EXTENDED_COLUMNS = ['full_vertices','simp_vertices','full_parts','simp_parts','full_valid','simp_valid',
+                        'minx','miny','maxx','maxy','full_area','simp_area','hausdorff_distance']
+
+    PERCENTILE_COLUMNS = ['spatial_full_size','spatial_simp_size','full_vertices','simp_vertices','hausdorff_distance']
+
+    PERCENTILES = [50, 90, 99, 100]
+
+    def __init__(self, ctx, csvout, quiet, extended=False):
+        self.logecho = ctx.obj['logecho']
+        self.csvout = csvout
+        self.quiet = quiet
+        self.extended = extended
+
+        self.pending = []
+        self.distributions = {column: [] for column in self.PERCENTILE_COLUMNS}
+
+        self.dataset_count = 0
+        self.spatial_dataset_count = 0
+        self.nonspatial_dataset_count = 0
+        self.spatial_full_total = 0
+        self.spatial_simp_total = 0
+
+        try:
+            self.csvfile = open(csvout, 'w', newline='')
+        except FileNotFoundError:
+            self.logecho("Unable to write CSV / File not found error", 'error')
+            sys.exit(1)
+        except Exception as e:
+            self.logecho(f"An unexpected error occurred, unable to write CSV: {e}", 'error')
+            sys.exit(1)
+
+        self.writer = csv.writer(self.csvfile)
+        header = ['id','name','spatial_full_size','spatial_simp_size','spatial_simp_reduction']
+        if extended:
+            header += self.EXTENDED_COLUMNS
+        self.writer.writerow(header)
+
+    def add(self, dataset):
+        self.dataset_count += 1
         spatial_full_size = 0
         spatial_simp_size = 0
         spatial_simp_reduction = 0
         if "gazetteer" in dataset:
             if dataset["gazetteer"]["spatial_full"] is not None:
-                spatial_full_size = len(dataset["gazetteer"]["spatial_full"].encode('utf-8'))
-                spatial_full_total += spatial_full_size
+                spatial_full_size = utf8_len(dataset["gazetteer"]["spatial_full"])
+                self.spatial_full_total += spatial_full_size
             else:
                 spatial_full_size = 0
 
             if dataset["gazetteer"]["spatial_simp"] is not None:
-                spatial_simp_size = len(dataset["gazetteer"]["spatial_simp"].encode('utf-8'))
-                spatial_simp_total += spatial_simp_size
+                spatial_simp_size = utf8_len(dataset["gazetteer"]["spatial_simp"])
+                self.spatial_simp_total += spatial_simp_size
             else:
                 spatial_simp_size = 0
 
             if dataset["gazetteer"]["spatial_full"] is not None or dataset["gazetteer"]["spatial_simp"] is not None:
-                spatial_dataset_count += 1
+                self.spatial_dataset_count += 1
                 if spatial_full_size > 0:
                   spatial_simp_reduction = '{}%'.format(round(( 100 - ( ( spatial_simp_size / spatial_full_size ) * 100 ) ), 2))
                 else:
                   spatial_simp_reduction = 'n/a'
-                logecho("{} / spatial_full: {} / spatial_simp: {} / reduction: {}".format(dataset["name"], spatial_full_size, spatial_simp_size, spatial_simp_reduction ), "info")
+                if not self.quiet:
+                    self.logecho("{} / spatial_full: {} / spatial_simp: {} / reduction: {}", "info", dataset["name"], spatial_full_size, spatial_simp_size, spatial_simp_reduction )
 
             else:
-                nonspatial_dataset_count += 1
+                self.nonspatial_dataset_count += 1
                 spatial_simp_reduction = 0
 
         else:
-            nonspatial_dataset_count += 1
+            self.nonspatial_dataset_count += 1
 
-    
-        csvdata.append( [dataset['id'], dataset['name'], spatial_full_size, spatial_simp_size, spatial_simp_reduction] )
+        row = [dataset['id'], dataset['name'], spatial_full_size, spatial_simp_size, spatial_simp_reduction]
 
-    logecho( "", "divider" )
-    logecho("{} spatial datasets".format(spatial_dataset_count), "info")
-    csvdata.insert(0,["# {} spatial datasets".format(spatial_dataset_count)])
-    logecho("{} nonspatial datasets".format(nonspatial_dataset_count), "info")
-    csvdata.insert(1,["# {} nonspatial datasets".format(nonspatial_dataset_count)])
-    logecho("spatial_full_total = {} bytes".format(spatial_full_total), "info")
-    csvdata.insert(2,["# spatial_full_total = {} bytes".format(spatial_full_total)])
-    logecho("spatial_simp_total = {} bytes".format(spatial_simp_total), "info")
-    csvdata.insert(3,["# spatial_simp_total = {} bytes".format(spatial_simp_total)])
-
-
-    if spatial_full_total > 0:
-        simplification_reduction = 100 - ( ( spatial_simp_total / spatial_full_total ) * 100 )
-    else:
-        simplification_reduction = 0
-    logecho("simplification reduction = {}%".format( round( simplification_reduction, 2 ) ), "info")
-    csvdata.insert(4,["# simplification reduction = {}%".format( round( simplification_reduction, 2 ) )])
+        if not self.extended:
+            self.writer.writerow(row)
+            return
 
-    try:
-        with open(csvout, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerows(csvdata)
-    
-    except FileNotFoundError:
-        logecho("Unable to write CSV / File not found error", 'error')
-        sys.exit(1)
-    except Exception as e:
-        logecho(f"An unexpected error occurred, unable to write CSV: {e}", 'error')
-        sys.exit(1)
+        gazetteer = dataset.get("gazetteer") or {}
+        self.pending.append((row, gazetteer.get("spatial_full"), gazetteer.get("spatial_simp")))
+        if len(self.pending) >= STATS_CHUNK:
+            self.flush()
 
-def fetch_datasets(ctx,ids=None,package_type='dataset'):
+    def flush(self):
+        """Compute the extended metrics of the pending rows and write them"""
+
+        if not self.pending:
+            return
+
+        rows, full_json, simp_json = zip(*self.pending)
+        self.pending = []
+
+        full = geometry_metrics(full_json)
+        simp = geometry_metrics(simp_json)
+        hausdorff = shapely.hausdorff_distance(full['geometry'], simp['geometry'])
+        bounds = shapely.bounds(full['geometry'])
+
+        for i, row in enumerate(rows):
+            metrics = [full['vertices'][i], simp['vertices'][i], full['parts'][i], simp['parts'][i],
+                       full['valid'][i], simp['valid'][i], *bounds[i],
+                       full['area'][i], simp['area'][i], hausdorff[i]]
+            self.writer.writerow(row + [stats_cell(value) for value in metrics])
+
+            if full['geometry'][i] is not None or simp['geometry'][i] is not None:
+                values = dict(zip(self.EXTENDED_COLUMNS, metrics), spatial_full_size=row[2], spatial_simp_size=row[3])
+                for column, distribution in self.distributions.items():
+                    distribution.append(values[column])
+
+    def close(self):
+        logecho = self.logecho
+
+        self.flush()
+
+        if self.spatial_full_total > 0:
+            simplification_reduction = 100 - ( ( self.spatial_simp_total / self.spatial_full_total ) * 100 )
+        else:
+            simplification_reduction = 0
+
+        summary = [
+            "{} spatial datasets".format(self.spatial_dataset_count),
+            "{} nonspatial datasets".format(self.nonspatial_dataset_count),
+            "spatial_full_total = {} bytes".format(self.spatial_full_total),
+            "spatial_simp_total = {} bytes".format(self.spatial_simp_total),
+            "simplification reduction = {}%".format( round( simplification_reduction, 2 ) ),
+        ]
+        if self.extended:
+            for column, distribution in self.distributions.items():
+                values = np.array(distribution, dtype=float)
+                if np.isnan(values).all():
+                    continue
+                summary.append("{} {}".format(column, " / ".join(
+                    "{} = {}".format('max' if q == 100 else 'p{}'.format(q), round(float(value), 6))
+                    for q, value in zip(self.PERCENTILES, np.nanpercentile(values, self.PERCENTILES))
+                )))
+        for line in summary:
+            logecho(line, "info")
+            self.writer.writerow(["# {}".format(line)])
+
+        self.csvfile.close()
+
+
+def geometry_metrics(json_texts):
+    """
+    Parse GeoJSON FeatureCollections into one GeometryCollection each, with
+    a single from_geojson call across all of their features, and return
+    the collections with per-collection vertex count, part count (polygons
+    in multipart features counted separately), validity and area. Missing
+    or unparseable collections give a None geometry.
+    """
+
+    count = len(json_texts)
+    geometry_json = []
+    index = []
+    for i, json_data in enumerate(json_texts):
+        if not json_data:
+            continue
+        try:
+            features = json.loads(json_data).get('features') or []
+        except (ValueError, AttributeError):
+            continue
+        for feature in features:
+            if feature.get('geometry'):
+                geometry_json.append(json.dumps(close_rings(feature['geometry'])))
+                index.append(i)
+
+    geometries = from_geojson(geometry_json, on_invalid='ignore')
+    index = np.array(index, dtype=np.intp)
+    parsed = ~shapely.is_missing(geometries)
+    geometries, index = geometries[parsed], index[parsed]
+
+    collections = np.empty(count, dtype=object)
+    if len(geometries):
+        collections = shapely.geometrycollections(geometries, indices=index, out=collections)
+
+    invalid = np.bincount(index, weights=~shapely.is_valid(geometries), minlength=count)
+    present = ~shapely.is_missing(collections)
+
+    return {
+        'geometry': collections,
+        'vertices': np.where(present, shapely.get_num_coordinates(collections), np.nan),
+        'parts': np.where(present, np.bincount(index, weights=shapely.get_num_geometries(geometries), minlength=count), np.nan),
+        'valid': np.where(present, invalid == 0, None),
+        'area': shapely.area(collections),
+    }
+
+
+def stats_cell(value):
+    """CSV cell for a metric: blank when missing, integral floats as integers"""
+
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if float(value).is_integer():
+        return int(value)
+    return round(float(value), 8)
+
+
+def utf8_len(text):
+    """Length of text encoded as UTF-8, without holding an encoded copy of all of it"""
+
+    if text.isascii():
+        return len(text)
+    return sum(len(text[i:i + UTF8_CHUNK].encode('utf-8')) for i in range(0, len(text), UTF8_CHUNK))
+
+
+def fetch_datasets(ctx,ids=None,package_type='dataset',fields=None):
 
-    twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
     if ids:
         logecho('Fetching {}s: {}'.format(package_type,ids) )
     else:
         logecho('Fetching all {}s'.format(package_type))
-    datasets = []
 
+    def datasets():
+        found = False
+        total = count_datasets(ctx, ids, package_type) if ctx.obj.get('progress') else None
+        for dataset in progress(ctx, iter_datasets(ctx, ids, package_type, fields=fields), total, '{}s'.format(package_type)):
+            found = True
+            yield dataset
+        if not found:
+            logecho( "No {}s found".format(package_type), 'warning')
+
+    return datasets()
+
+
+def progress(ctx, items, total=None, label=''):
+    """
+    Yield items, drawing a progress bar with throughput and ETA on stderr
+    in --progress mode. While it is drawn logecho keeps per-dataset lines
+    off the console; they still go to the logfile.
+    """
+
+    if not ctx.obj.get('progress'):
+        yield from items
+        return
+
+    active = ctx.obj['progress_active']
+    start = perf_counter()
+    done = 0
+
+    active.set()
+    try:
+        with click.progressbar(length=total, label=label, show_eta=True, show_pos=True,
+                               item_show_func=lambda rate: rate, file=sys.stderr) as bar:
+            for item in items:
+                yield item
+                done += 1
+                bar.update(1, '{:.1f}/s'.format(done / max(perf_counter() - start, 1e-6)))
+    finally:
+        active.clear()
+
+
+def count_datasets(ctx,ids=None,package_type='dataset'):
+    """Number of datasets fetch_datasets would yield, without fetching them"""
+
+    twdh = ctx.obj['twdh']
+
+    if ids:
+        return len(ids.split())
+
+    if ctx.obj.get('local'):
+        return ctx.obj['mirror'].count(package_type)
+
+    query = twdh.action.package_search(
+        rows=0,
+        fq="type:{}".format(package_type),
+        include_drafts=True,
+        include_private=True
+    )
+    return query["count"]
+
+
+def facet_counts(ctx, dimensions, ids=None, package_type='dataset'):
+    """
+    Count datasets for every combination of values of the facet fields in
+    dimensions, returning {(value, ...): count} with zeros for combinations
+    that do not occur. package_search has no pivot facets, so one rows=0
+    query finds the values of each dimension and then one rows=0 query per
+    combination of all but the last dimension, run concurrently, facets
+    on the last one. With --local the mirror is counted instead.
+    """
+
+    twdh = ctx.obj['twdh']
+    concurrency = ctx.obj.get('concurrency') or CONCURRENCY
+
+    if ctx.obj.get('local'):
+        found = Counter(
+            tuple(facet_value(dataset, field) for field in dimensions)
+            for dataset in iter_datasets(ctx, ids, package_type)
+        )
+        values = [sorted(set(combination[i] for combination in found)) for i in range(len(dimensions))]
+        return {combination: found[combination] for combination in product(*values)}
+
+    fq_list = ['type:{}'.format(package_type)]
     if ids:
-      id_list = ids.split()
-      for id in id_list:
-          try:
-
-              dataset = twdh.action.package_show( id=id )
-              if dataset:
-                  datasets.append( dataset )
-          except Exception as e:
-              logecho( "Exception loading dataset {}: {}".format( id, e ), 'error')
-              exit(1)
+        # --ids takes names as well as ids, as package_show does
+        terms = ' OR '.join('"{}"'.format(id) for id in ids.split())
+        fq_list.append('(id:({0}) OR name:({0}))'.format(terms))
+
+    def search(filters):
+        result = twdh.action.package_search(
+            rows=0,
+            fq_list=fq_list + ['{}:"{}"'.format(field, value) for field, value in filters],
+            facet='true',
+            **{'facet.field': [dimensions[-1]] if filters else list(dimensions), 'facet.limit': -1},
+            include_private=True,
+            include_drafts=True
+        )
+        return {
+            field: {item['name']: item['count'] for item in facet['items']}
+            for field, facet in result['search_facets'].items()
+        }
+
+    facets = search([])
+    values = [sorted(facets.get(field, {})) for field in dimensions]
+
+    counts = {}
+    prefixes = list(product(*values[:-1]))
+    if len(dimensions) == 1:
+        last_counts = [((), facets.get(dimensions[0], {}))]
     else:
-      query = twdh.action.package_search(
-          rows=100000,
-          fq="type:{}".format(package_type),
-          include_drafts=True,
-          include_private=True
-      )
-      if query["count"] == 0:
-          logecho( "No datasets found", 'error')
-          exit(1)
-      else:
-          datasets=query["results"]
+        last_counts = (
+            (prefix, future.result().get(dimensions[-1], {}))
+            for prefix, future in bounded_map(
+                search, prefixes, concurrency, arg=lambda prefix: list(zip(dimensions, prefix)))
+        )
+
+    for prefix, last in last_counts:
+        for value in values[-1]:
+            counts[prefix + (value,)] = last.get(value, 0)
+
+    return counts
+
+
+def facet_value(dataset, field):
+    """A dataset field as package_search facets report it"""
+
+    value = dataset.get(field)
+    if field == 'organization':
+        value = (value or {}).get('name')
+    if isinstance(value, bool):
+        return str(value).lower()
+    return '' if value is None else str(value)
 
-    return datasets
 
+def iter_datasets(ctx, ids=None, package_type='dataset', page_size=None, sort='id asc', fields=None, **search_args):
+    """
+    Yield datasets one at a time, paging through package_search with a
+    stable sort. The next page is requested in the background while the
+    current one is being consumed, so at most two pages are held in memory.
+    With --local they are read from the mirror instead.
 
-def simplify_geojson_by_size(ctx, json_data, max_bytes, tolerance_step=0.0001):
+    With a list of fields, datasets only have those top-level keys. When
+    they are all STORED_FIELDS the list is passed to package_search as fl,
+    so the rest of each dataset (resources, extras, gazetteer geometries,
+    ...) is never transferred; otherwise full datasets are fetched and
+    projected.
+    """
 
     twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
+    if ctx.obj.get('local'):
+        for dataset in ctx.obj['mirror'].datasets(ids, package_type):
+            yield project_fields(dataset, fields)
+        return
+
+    if ids:
+        for id in ids.split():
+            try:
+                dataset = twdh.action.package_show( id=id )
+            except Exception as e:
+                logecho( "Exception loading dataset {}: {}".format( id, e ), 'error')
+                exit(1)
+            if dataset:
+                yield project_fields(dataset, fields)
+        return
+
+    page_size = page_size or ctx.obj.get('page_size') or PAGE_SIZE
+    if fields and STORED_FIELDS.issuperset(fields):
+        search_args['fl'] = list(fields)
+        fields = None
+    search_args.setdefault('include_drafts', True)
+    search_args.setdefault('include_private', True)
+
+    def fetch_page(start):
+        return twdh.action.package_search(
+            fq="type:{}".format(package_type),
+            sort=sort,
+            start=start,
+            rows=page_size,
+            **search_args
+        )
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        start = 0
+        page = executor.submit(fetch_page, start)
+        while page is not None:
+            query = page.result()
+            start += page_size
+            if query["results"] and start < query["count"]:
+                page = executor.submit(fetch_page, start)
+            else:
+                page = None
+
+            for dataset in query["results"]:
+                yield project_fields(dataset, fields)
+
+
+def search_datasets(ctx, rows=10, **filters):
+    """
+    Datasets whose fields equal filters (e.g. state='active', private=False),
+    at most rows of them, from package_search or with --local the mirror
+    """
+
+    if ctx.obj.get('local'):
+        return list(ctx.obj['mirror'].datasets(limit=rows, **filters))
+
+    query = ctx.obj['twdh'].action.package_search(
+        fq_list=['{}:{}'.format(field, str(value).lower() if isinstance(value, bool) else value)
+                 for field, value in filters.items()],
+        rows=rows
+    )
+    return query['results']
+
+
+def require_live(ctx):
+    """Read datasets from CKAN even with --local, for commands that change them"""
+
+    if ctx.obj.get('local'):
+        ctx.obj['logecho']( "--local is ignored by this command, reading datasets from CKAN", 'warning' )
+        ctx.obj['local'] = False
+
+
+def sync(ctx, mirror, full=False):
+    """
+    Bring the local mirror up to date: fetch packages modified since the
+    newest metadata_modified already mirrored (everything the first time,
+    or with full), then drop packages an id listing no longer returns.
+    Deleted packages are kept with state deleted, as package_search
+    reports them. Returns {type: (updated, removed)}.
+    """
+
+    logecho = ctx.obj['logecho']
+    host = ctx.obj['twdh'].address
+
+    mirrored_host = mirror.get_meta('host')
+    if mirrored_host and mirrored_host != host:
+        logecho( "Mirror {} is a copy of {}, not {}".format(mirror.path, mirrored_host, host), 'error' )
+        sys.exit(1)
+    mirror.set_meta('host', host)
+
+    results = {}
+    for package_type in MIRROR_TYPES:
+        since = None if full else mirror.last_modified(package_type)
+        if since:
+            logecho( "Syncing {}s modified since {}".format(package_type, since) )
+        else:
+            logecho( "Syncing all {}s".format(package_type) )
+
+        changed = iter_datasets(ctx, package_type=package_type, include_deleted=True,
+                                fq_list=['metadata_modified:[{}Z TO *]'.format(since)] if since else [])
+        updated = mirror.update(changed)
+
+        listing = iter_datasets(ctx, package_type=package_type, include_deleted=True, fl=['id'])
+        removed = mirror.remove_missing(package_type, (dataset['id'] for dataset in listing))
+
+        results[package_type] = (updated, removed)
+
+    mirror.set_meta('synced', datetime.now().isoformat())
+    return results
+
+
+class Mirror:
+    """
+    Local SQLite copy of package metadata, kept up to date by sync() and
+    read by iter_datasets with --local. The full package dict is stored
+    as JSON next to indexed columns for the fields commands filter on.
+    """
+
+    COLUMNS = ['id', 'name', 'type', 'title', 'organization', 'state', 'private',
+               'data_admin_approved', 'metadata_modified']
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS packages (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            type TEXT,
+            title TEXT,
+            organization TEXT,
+            state TEXT,
+            private INTEGER,
+            data_admin_approved TEXT,
+            metadata_modified TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+        CREATE INDEX IF NOT EXISTS packages_type ON packages (type, metadata_modified);
+        CREATE INDEX IF NOT EXISTS packages_organization ON packages (organization);
+        CREATE INDEX IF NOT EXISTS packages_state ON packages (state);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def last_modified(self, package_type):
+        return self.db.execute(
+            "SELECT max(metadata_modified) FROM packages WHERE type = ?", (package_type,)).fetchone()[0]
+
+    def update(self, datasets):
+        """Insert or replace datasets, returning how many there were"""
+
+        count = 0
+        with self.db:
+            for dataset in datasets:
+                organization = dataset.get('organization') or {}
+                self.db.execute(
+                    "INSERT OR REPLACE INTO packages ({}, data) VALUES ({}?)".format(
+                        ', '.join(self.COLUMNS), '?, ' * len(self.COLUMNS)),
+                    (dataset['id'], dataset.get('name'), dataset.get('type'), dataset.get('title'),
+                     organization.get('name'), dataset.get('state'),
+                     None if dataset.get('private') is None else int(dataset['private']),
+                     dataset.get('data_admin_approved'), dataset.get('metadata_modified'),
+                     json.dumps(dataset, separators=(',', ':')))
+                )
+                count += 1
+        return count
+
+    def remove_missing(self, package_type, ids):
+        """Delete packages of package_type whose id is not in ids, returning how many"""
+
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM listed")
+            self.db.executemany("INSERT OR IGNORE INTO listed (id) VALUES (?)", ((id,) for id in ids))
+            removed = self.db.execute(
+                "DELETE FROM packages WHERE type = ? AND id NOT IN (SELECT id FROM listed)",
+                (package_type,)).rowcount
+            self.db.execute("DELETE FROM listed")
+        return removed
+
+    def _where(self, ids=None, package_type=None, **filters):
+        clauses = ["state != 'deleted'"]
+        params = []
+        if ids:
+            ids = ids.split()
+            marks = ', '.join('?' * len(ids))
+            clauses.append("(id IN ({0}) OR name IN ({0}))".format(marks))
+            params += ids + ids
+        if package_type:
+            clauses.append("type = ?")
+            params.append(package_type)
+        for field, value in filters.items():
+            if field not in self.COLUMNS:
+                raise ValueError("Cannot filter the mirror on {}".format(field))
+            if field == 'private' and not isinstance(value, bool):
+                value = str(value).lower() == 'true'
+            clauses.append("{} = ?".format(field))
+            params.append(int(value) if isinstance(value, bool) else value)
+        return ' AND '.join(clauses), params
+
+    def datasets(self, ids=None, package_type=None, limit=None, **filters):
+        """Yield mirrored datasets that are not deleted, sorted by id"""
+
+        where, params = self._where(ids, package_type, **filters)
+        query = "SELECT data FROM packages WHERE {} ORDER BY id".format(where)
+        if limit is not None:
+            query += " LIMIT {:d}".format(limit)
+        for (data,) in self.db.execute(query, params):
+            yield json.loads(data)
+
+    def count(self, package_type=None, **filters):
+        where, params = self._where(None, package_type, **filters)
+        return self.db.execute("SELECT count(*) FROM packages WHERE {}".format(where), params).fetchone()[0]
+
+
+def open_journal(ctx, command, params, path=None, resume=None):
+    """
+    Journal for a patch run: the --resume journal when given, else path,
+    else a new file named after command, host and time in ./twdh-journals
+    """
+
+    logecho = ctx.obj['logecho']
+
+    if resume:
+        path = resume
+    elif not path:
+        path = "./twdh-journals/{}_{}_{}.jsonl".format(
+            command, urlparse(ctx.obj['twdh'].address).netloc, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+
+    journal = Journal(path, dict(params, command=command))
+    if resume:
+        if journal.params != journal.run_params:
+            logecho( "Resuming a run with different parameters: {}".format(journal.params), 'warning' )
+        logecho( "Resuming from {}: skipping {} completed datasets".format(path, len(journal.completed)), 'note' )
+    else:
+        logecho( "Journal: {} (rerun with --resume {} to continue if interrupted)".format(path, path), 'detail' )
+
+    return journal
+
+
+class Journal:
+    """
+    Append-only JSONL record of the outcome of each dataset in a patch run,
+    flushed line by line so it survives the run being killed. The first
+    line holds the run parameters. Opening an existing journal reads the
+    ids of the datasets it completed, so a rerun can skip them.
+    """
+
+    COMPLETED = ('patched', 'identical', 'unchanged')
+
+    def __init__(self, path, params):
+        self.path = path
+        self.run_params = params
+        self.params = params
+        self.completed = set()
+
+        exists = os.path.exists(path)
+        line = '\n'
+        if exists:
+            with open(path, encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Cut short by the interrupted run
+                        continue
+                    if 'params' in entry:
+                        self.params = entry['params']
+                    elif entry.get('outcome') in self.COMPLETED:
+                        self.completed.add(entry['id'])
+        else:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self.journal_file = open(path, 'a', encoding='utf-8')
+        if not line.endswith('\n'):
+            self.journal_file.write('\n')
+        if not exists:
+            self._write({'started': datetime.now().isoformat(), 'params': params})
+
+    def _write(self, entry):
+        self.journal_file.write(json.dumps(entry) + '\n')
+        self.journal_file.flush()
+
+    def pending(self, datasets):
+        """The datasets not completed by an earlier run"""
+
+        return (dataset for dataset in datasets if dataset.get('id') not in self.completed)
+
+    def pending_count(self, total):
+        """How many of total datasets are left once those completed by an earlier run are skipped"""
+
+        return max(0, total - len(self.completed))
+
+    def record(self, dataset, outcome):
+        self._write({'id': dataset.get('id'), 'name': dataset.get('name'), 'outcome': outcome,
+                     'ts': datetime.now().isoformat()})
+
+    def close(self):
+        self.journal_file.close()
+
+
+def spatial_hash(gazetteer):
+    """sha256 of a gazetteer's spatial_full and spatial_simp, telling None from ''"""
+
+    digest = hashlib.sha256()
+    for value in (gazetteer.get('spatial_full'), gazetteer.get('spatial_simp')):
+        if value is None:
+            digest.update(b'-:')
+        else:
+            encoded = value.encode('utf-8')
+            digest.update('{}:'.format(len(encoded)).encode('utf-8'))
+            digest.update(encoded)
+    return digest.hexdigest()
+
+
+def live_spatial_hashes(ctx, ids=None):
+    """
+    {id: spatial_hash} of the live datasets and applications, including
+    deleted ones as snapshots do. The nested gazetteer is not a Solr stored
+    field, so whole datasets are fetched (package_show with ids) and only
+    the hashes are kept. Packages without a gazetteer are left out, so
+    callers treat them as different.
+    """
+
+    hashes = {}
+    for package_type in ([None] if ids else ['dataset', 'application']):
+        for dataset in iter_datasets(ctx, ids, package_type, include_deleted=True):
+            if isinstance(dataset.get('gazetteer'), dict):
+                hashes[dataset['id']] = spatial_hash(dataset['gazetteer'])
+    return hashes
+
+
+def current_value(dataset, field):
+    """
+    Value of a package_patch field in a fetched dataset: a top-level key,
+    else a gazetteer key (spatial_full, spatial_simp, ...), else an extra.
+    None when the dataset has no such field.
+    """
+
+    if field in dataset:
+        return dataset[field]
+    gazetteer = dataset.get('gazetteer')
+    if isinstance(gazetteer, dict) and field in gazetteer:
+        return gazetteer[field]
+    for extra in dataset.get('extras') or []:
+        if extra.get('key') == field:
+            return extra.get('value')
+    return None
+
+
+def diff_changes(dataset, changes):
+    """
+    The changes whose values differ from dataset. Setting a field the
+    dataset does not have to '' or None is not a difference.
+
+    SPATIAL_FIELDS are patched together: the gazetteer is rebuilt from
+    both, so when one differs the other is sent too, from changes or else
+    from the dataset.
+    """
+
+    diff = {}
+    for field, value in changes.items():
+        current = current_value(dataset, field)
+        if current == value or (current is None and value in ('', None)):
+            continue
+        diff[field] = value
+
+    if any(field in diff for field in SPATIAL_FIELDS):
+        for field in SPATIAL_FIELDS:
+            if field in diff:
+                continue
+            value = changes[field] if field in changes else current_value(dataset, field)
+            if value is not None:
+                diff[field] = value
+
+    return diff
+
+
+def preview(value, width=60):
+    """Short printable form of a field value, for logging diffs"""
+
+    text = value if isinstance(value, str) else json.dumps(value)
+    if len(text) > width:
+        return '{}... ({} chars)'.format(text[:width], len(text))
+    return text
+
+
+def abridged(value, width=200):
+    """value with strings longer than width shortened by preview, for printing whole datasets"""
+
+    if isinstance(value, str):
+        return preview(value, width)
+    if isinstance(value, dict):
+        return {key: abridged(item, width) for key, item in value.items()}
+    if isinstance(value, list):
+        return [abridged(item, width) for item in value]
+    return value
+
+
+def project_fields(dataset, fields):
+    """dataset with only the top-level keys in fields, or all of them for no fields"""
+
+    if not fields:
+        return dataset
+    return {field: dataset[field] for field in fields if field in dataset}
+
+
+def bounded_map(fn, items, workers, in_flight=None, stop=None, arg=None, executor_class=ThreadPoolExecutor):
+    """
+    Run fn over items on a thread pool, yielding (item, future) pairs in
+    input order. At most in_flight calls (default 2 x workers) are pending
+    at once, so items can be a lazy iterator. Once the stop event is set
+    no new calls are scheduled and the pending ones are drained.
+
+    fn is called with arg(item) when arg is given. Pass a
+    ProcessPoolExecutor as executor_class for CPU-bound work; fn and
+    what it is called with must then be picklable.
+    """
+
+    in_flight = in_flight or workers * 2
+    pending = deque()
+
+    with executor_class(max_workers=workers) as executor:
+        try:
+            items = iter(items)
+            while True:
+                while len(pending) < in_flight and not (stop and stop.is_set()):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    pending.append((item, executor.submit(fn, arg(item) if arg else item)))
+
+                if not pending:
+                    break
+                yield pending.popleft()
+        finally:
+            for item, future in pending:
+                future.cancel()
+
+
+def buffered_ctx(ctx):
+    """
+    Copy of ctx whose logecho collects messages instead of printing them,
+    so work done on a pool can be logged in order from the main thread.
+    Returns the copy and the list of (message, level) tuples.
+    """
+
+    messages = []
+
+    def logecho(message, level='info', *args):
+        messages.append((message.format(*args) if args else message, level))
+
+    return SimpleNamespace(obj=dict(ctx.obj, logecho=logecho)), messages
+
+
+def simplify_geojson_by_size(ctx, json_data, max_bytes, tolerance_step=0.0001, max_tolerance=0.25):
+    """
+    Simplify GeoJSON to at most max_bytes, see simplify_to_size. Results
+    are looked up in and saved to ctx.obj['simplify_cache'] when set.
+    """
+
+    logecho = ctx.obj['logecho']
+
+    json_str, messages = simplify_cached(json_data, max_bytes, ctx.obj.get('simplify_cache'),
+                                         tolerance_step, max_tolerance)
+    for message, level in messages:
+        logecho(message, level)
+
+    return json_str
+
+
+def simplify_to_size(json_data, max_bytes, tolerance_step=0.0001, max_tolerance=0.25, max_digits=6, min_digits=4):
+    """
+    Shrink a GeoJSON FeatureCollection until it serializes to at most
+    max_bytes.
+
+    Most of the bytes are coordinate decimals, so coordinates are first
+    snapped to max_digits decimal places, then one fewer, down to
+    min_digits (shapely.set_precision, rounding each coordinate on its own
+    so that invalid input geometries are rounded too). The first precision
+    that fits is used and no vertex is dropped.
+
+    Only when rounding alone is not enough are the min_digits geometries
+    simplified as well. The tolerance is found by doubling it until the output fits
+    and then bisecting between the last size that didn't fit and the first
+    one that did, down to tolerance_step. That takes a logarithmic number
+    of simplify passes, where stepping by tolerance_step could take
+    max_tolerance / tolerance_step of them. The collection is parsed once
+    into a Shapely geometry array that every pass reuses. Returns the
+    largest output that fits, or json_data unchanged if none does.
+
+    Takes no ctx so that it can run in a worker process: returns the
+    output together with the (message, level) pairs to log.
+    """
+
+    messages = []
+
+    def logecho(message, level='info', *args):
+        messages.append((message.format(*args) if args else message, level))
+
+    orig_size = utf8_len(json_data)
+    if orig_size <= max_bytes:
+        return json_data, messages
+
     try:
-        data = json.loads(json_data)
-    except (json.JSONDecodeError, AttributeError, IndexError, TypeError) as e:
-        log.error(f"Error processing json data: {e}")
-        return json_data
-
-    tolerance = 0.0
-    current_size = len(json_data.encode('utf-8'))
-    orig_size = current_size
-    
-    while current_size > max_bytes and tolerance < 0.25: # Max 0.25 tolerance
-        tolerance += tolerance_step
-        new_features = []
-        for feature in data['features']:
-            geom = shape(feature['geometry'])
-            # Simplify geometry
-            simplified_geom = geom.simplify(tolerance, preserve_topology=True)
-            
-            # Update feature
-            new_feature = feature.copy()
-            new_feature['geometry'] = mapping(simplified_geom)
-            new_features.append(new_feature)
-            
-        new_data = {'type': 'FeatureCollection', 'features': new_features}
-        # Serialize with low precision to save bytes
-        json_str = json.dumps(new_data, separators=(',', ':'))
+        features = FeatureArray(json_data)
+    except (json.JSONDecodeError, AttributeError, IndexError, KeyError, TypeError, shapely.errors.GEOSException) as e:
+        logecho(f"Error processing json data: {e}", 'error')
+        return json_data, messages
+
+    iterations = 0
+    best = None # (size, json_str, tolerance) of the largest output that fits
+    smallest_size = orig_size
+
+    # Quantize: keep as many decimal places as fit
+    geometries = features.geometries
+    precision = 'none'
+    for digits in range(max_digits, min_digits - 1, -1):
+        try:
+            quantized = shapely.set_precision(features.geometries, 10.0 ** -digits, mode='pointwise')
+        except shapely.errors.GEOSException as e:
+            logecho(f"Could not round coordinates to {digits} digits: {e}", 'warning')
+            break
+
+        iterations += 1
+        geometries = quantized
+        precision = f"{digits} digits"
+        json_str = features.to_json(geometries)
         current_size = len(json_str.encode('utf-8'))
-        
-        #log.info( "-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-")
+        smallest_size = min(smallest_size, current_size)
         if current_size <= max_bytes:
             reduction = 100 - (( current_size / orig_size ) * 100)
-            logecho(f"Original Size: {orig_size} bytes / Final size: {current_size} bytes / Reduction: {round(reduction, 2)}% / Tolerance: {round(tolerance, 4)}", 'info')
-            return json_str
+            logecho(f"Original Size: {orig_size} bytes / Final size: {current_size} bytes / Reduction: {round(reduction, 2)}% / Precision: {precision} / Iterations: {iterations}", 'info')
+            return json_str, messages
+
+    def simplify(tolerance):
+        # One vectorized pass over every geometry of the collection
+        return features.to_json(shapely.simplify(geometries, tolerance, preserve_topology=True))
+
+    def attempt(tolerance):
+        nonlocal iterations, best, smallest_size
+        iterations += 1
+        json_str = simplify(tolerance)
+        size = len(json_str.encode('utf-8'))
+        smallest_size = min(smallest_size, size)
+        fits = size <= max_bytes
+        if fits and (best is None or size > best[0]):
+            best = (size, json_str, tolerance)
+        return fits
+
+    # Gallop: double the tolerance until the output fits
+    too_big = 0.0
+    fits_at = None
+    tolerance = tolerance_step
+    while fits_at is None and too_big < max_tolerance:
+        tolerance = min(tolerance, max_tolerance)
+        if attempt(tolerance):
+            fits_at = tolerance
+        else:
+            too_big = tolerance
+            tolerance *= 2
+
+    if fits_at is None:
+        logecho("Could not reach target size without losing too much detail. Current size={}".format(smallest_size), 'info')
+        return json_data, messages
+
+    # Bisect: the smallest tolerance that fits lies in (too_big, fits_at]
+    while fits_at - too_big > tolerance_step:
+        tolerance = (too_big + fits_at) / 2
+        if attempt(tolerance):
+            fits_at = tolerance
+        else:
+            too_big = tolerance
+
+    current_size, json_str, tolerance = best
+    reduction = 100 - (( current_size / orig_size ) * 100)
+    logecho(f"Original Size: {orig_size} bytes / Final size: {current_size} bytes / Reduction: {round(reduction, 2)}% / Precision: {precision} / Tolerance: {round(tolerance, 4)} / Iterations: {iterations} (stepped search: {int(round(tolerance / tolerance_step))})", 'info')
+    return json_str, messages
+
+
+def simplify_cached(json_data, max_bytes, cache=None, tolerance_step=0.0001, max_tolerance=0.25):
+    """
+    simplify_to_size, returning the SimplifyCache entry instead when there
+    is one. Only outputs that were simplified to fit are cached.
+    """
+
+    if cache is None:
+        return simplify_to_size(json_data, max_bytes, tolerance_step, max_tolerance)
+
+    key = cache.key(json_data, max_bytes, tolerance_step, max_tolerance)
+    json_str = cache.get(key)
+    if json_str is not None:
+        return json_str, [("Cached spatial_simp: {} bytes".format(utf8_len(json_str)), 'info')]
+
+    json_str, messages = simplify_to_size(json_data, max_bytes, tolerance_step, max_tolerance)
+    if json_str is not json_data:
+        # Only successful simplifications: a failed one returns json_data
+        # unchanged, and should be tried again next time
+        cache.put(key, json_str)
+    return json_str, messages
+
+
+def simplify_job(job):
+    """Process pool entry point: simplify_cached(*job), or None for no job"""
+
+    if job is None:
+        return None
+    return simplify_cached(*job)
+
+
+class SimplifyCache:
+    """
+    On-disk cache of simplify_to_size results, keyed by a hash of the input
+    GeoJSON, the target size, the search parameters and SIMPLIFY_VERSION.
+    Entries are files, so worker processes can share the cache; a hit
+    refreshes the entry's mtime and evict() removes the least recently
+    used entries until the cache fits in max_bytes.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def key(self, json_data, max_bytes, tolerance_step, max_tolerance):
+        digest = hashlib.sha256('{}:{}:{}:{}:'.format(
+            SIMPLIFY_VERSION, max_bytes, tolerance_step, max_tolerance).encode('utf-8'))
+        digest.update(json_data.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, encoding='utf-8') as entry_file:
+                json_str = entry_file.read()
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return None
+        return json_str
+
+    def put(self, key, json_str):
+        entry_path = self._entry_path(key)
+        Path(entry_path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as entry_file:
+            entry_file.write(json_str)
+        os.replace(tmp_path, entry_path)
+
+    def evict(self):
+        """Remove least recently used entries over max_bytes, returning how many"""
+
+        entries = []
+        for entry_path in Path(self.path).glob('*/*.json'):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total = sum(size for mtime, size, entry_path in entries)
+        evicted = 0
+        for mtime, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            entry_path.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+
+        return evicted
+
+
+def close_rings(geometry):
+    """
+    GeoJSON geometry dict with every polygon ring closed. from_geojson
+    rejects unclosed rings, which shape() used to close silently.
+    """
+
+    def close(ring):
+        return ring + [ring[0]] if ring and ring[0] != ring[-1] else ring
+
+    geometry_type = geometry.get('type')
+    if geometry_type == 'Polygon':
+        return dict(geometry, coordinates=[close(ring) for ring in geometry.get('coordinates') or []])
+    if geometry_type == 'MultiPolygon':
+        return dict(geometry, coordinates=[[close(ring) for ring in polygon]
+                                           for polygon in geometry.get('coordinates') or []])
+    if geometry_type == 'GeometryCollection':
+        return dict(geometry, geometries=[close_rings(part) for part in geometry.get('geometries') or []])
+    return geometry
+
+
+class FeatureArray:
+    """
+    A GeoJSON FeatureCollection parsed once into a Shapely geometry array,
+    with each feature's remaining JSON (type, properties, ...) serialized
+    up front as the text before and after its geometry. Geometries derived
+    from the array (simplified, quantized, ...) can then be serialized back
+    into a compact FeatureCollection with one vectorized to_geojson call.
+    """
+
+    GEOMETRY_MARKER = '__twdhcli_geometry__'
+
+    def __init__(self, json_data):
+        features = json.loads(json_data)['features']
+
+        self.geometries = from_geojson([
+            json.dumps(close_rings(feature['geometry'])) if feature.get('geometry') else None
+            for feature in features
+        ])
+
+        self.templates = []
+        for feature in features:
+            template = dict(feature, geometry=self.GEOMETRY_MARKER)
+            prefix, suffix = json.dumps(template, separators=(',', ':')).split(
+                '"{}"'.format(self.GEOMETRY_MARKER), 1)
+            self.templates.append((prefix, suffix))
+
+    def to_json(self, geometries):
+        geometry_json = to_geojson(geometries)
+        return '{"type":"FeatureCollection","features":[' + ','.join(
+            prefix + (geojson if geojson is not None else 'null') + suffix
+            for (prefix, suffix), geojson in zip(self.templates, geometry_json)
+        ) + ']}'
+
+
+def make_session(pool_size, user_agent=None):
+    """
+    requests.Session for the CKAN API: one keep-alive connection pool per
+    host holding up to pool_size connections, so concurrent calls reuse
+    connections instead of opening new ones, and gzip responses.
+    """
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    if user_agent:
+        session.headers['User-Agent'] = user_agent
+    return session
+
+
+def session_stats(session):
+    """(requests, connections opened) so far by session's connection pools"""
+
+    requests_made = connections = 0
+    # make_session mounts one adapter for both http:// and https://
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            requests_made += pool.num_requests
+            connections += pool.num_connections
+    return requests_made, connections
+
+
+class RetryingCKAN(ckanapi.RemoteCKAN):
+    """
+    RemoteCKAN that retries idempotent actions (*_show, *_list, *_search,
+    package_patch, package_update) when the call fails with 429/502/503/504
+    or a connection error, with jittered exponential backoff that honours
+    Retry-After. Every call also goes through an AdaptiveLimiter, so the
+    number of requests in flight backs off when CKAN struggles and grows
+    back up to max_concurrency when it copes.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    IDEMPOTENT_SUFFIXES = ('_show', '_list', '_search')
+
+    IDEMPOTENT_ACTIONS = ('package_patch', 'package_update')
+
+    def __init__(self, address, apikey=None, user_agent=None, session=None,
+                 retries=RETRIES, max_concurrency=CONCURRENCY, logecho=None,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        super().__init__(address, apikey=apikey, user_agent=user_agent, session=session)
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = AdaptiveLimiter(max_concurrency)
+        self.logecho = logecho or (lambda message, level='info': None)
+        self.retried = 0
+        self._response = threading.local()
+
+    def _request_fn(self, url, data, headers, files, requests_kwargs):
+        # As RemoteCKAN._request_fn, keeping the status and Retry-After for call_action
+        response = self.session.post(url, data=data, headers=headers, files=files,
+            allow_redirects=False, **requests_kwargs)
+        self._response.status = response.status_code
+        self._response.retry_after = response.headers.get('Retry-After')
+        return response.status_code, response.text
+
+    def idempotent(self, action):
+        return action.endswith(self.IDEMPOTENT_SUFFIXES) or action in self.IDEMPOTENT_ACTIONS
+
+    def call_action(self, action, data_dict=None, context=None, apikey=None,
+            files=None, requests_kwargs=None):
+        requests_kwargs = dict(requests_kwargs or {})
+        requests_kwargs.setdefault('timeout', self.timeout)
+
+        key = self.latency_key(action, data_dict)
+        attempt = 0
+        while True:
+            self._response.status = None
+            self._response.retry_after = None
+
+            self.limiter.acquire()
+            start = perf_counter()
+            try:
+                result = super().call_action(action, data_dict, context, apikey, files, requests_kwargs)
+            except (ckanapi.CKANAPIError, requests.ConnectionError, requests.Timeout) as e:
+                status = self._response.status
+                reason = status or type(e).__name__
+                overloaded = status in self.RETRY_STATUSES or not isinstance(e, ckanapi.CKANAPIError)
+                self.limiter.release(key, perf_counter() - start, overloaded)
+                if not overloaded or files or not self.idempotent(action) or attempt >= self.retries:
+                    raise
+            except BaseException:
+                self.limiter.release(key, perf_counter() - start, False)
+                raise
+            else:
+                self.limiter.release(key, perf_counter() - start, False)
+                return result
+
+            delay = self.backoff(attempt, self._response.retry_after)
+            attempt += 1
+            self.retried += 1
+            self.logecho( "{} failed ({}), retry {} of {} in {}s".format(
+                action, reason, attempt, self.retries, round(delay, 2)), 'debug' )
+            time.sleep(delay)
+
+    def latency_key(self, action, data_dict):
+        """
+        Calls whose latencies the limiter compares: the action and, for
+        searches, the size of the page asked for (rows in powers of two,
+        and whether it is cut down with fl), so rows=0 counts do not make
+        full pages look slow.
+        """
+
+        rows = (data_dict or {}).get('rows')
+        if rows is None:
+            return action
+        return '{}/{}{}'.format(action, int(rows).bit_length(), '/fl' if data_dict.get('fl') else '')
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before retry attempt + 1: full jitter, but no less than Retry-After"""
+
+        delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+        return max(delay, retry_after_seconds(retry_after))
+
+
+def retry_after_seconds(value):
+    """Seconds asked for by a Retry-After header, in seconds or as an HTTP date"""
+
+    if not value:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return max(0, (when - datetime.now(when.tzinfo)).total_seconds())
+
+
+class AdaptiveLimiter:
+    """
+    Limit on concurrent calls adjusted AIMD style, as TCP does: each call
+    that succeeds in normal time raises the limit by 1/limit (about one per
+    round of calls) up to max_limit; a call that fails as overloaded, or
+    takes over LATENCY_FACTOR times the running average for its kind of
+    call (see RetryingCKAN.latency_key), halves it. Calls failing together
+    count as one decrease. Slowness only counts once the average is built
+    from MIN_SAMPLES calls, and for calls taking over SLOW_SECONDS, so
+    ordinary jitter on fast calls leaves the limit alone.
+    """
+
+    LATENCY_FACTOR = 3
+
+    MIN_SAMPLES = 10
+
+    SLOW_SECONDS = 0.3
+
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.latency = {}
+        self.samples = {}
+        self.decreased = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, key, seconds, overloaded):
+        with self.condition:
+            self.in_flight -= 1
+
+            average = self.latency.get(key)
+            slow = self.samples.get(key, 0) >= self.MIN_SAMPLES and \
+                seconds > max(self.LATENCY_FACTOR * average, self.SLOW_SECONDS)
+            if not overloaded:
+                self.latency[key] = seconds if average is None else average + (seconds - average) / 10
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+            now = perf_counter()
+            if overloaded or slow:
+                if now - self.decreased > (average or seconds):
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased = now
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
 
-    logecho("Could not reach target size without losing too much detail. Current size={}".format(current_size), 'info')
-    return json_data
+            self.condition.notify_all()
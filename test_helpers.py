@@ -0,0 +1,267 @@
+import io
+import json
+import math
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import helpers as h
+
+
+class FakeAction:
+    """package_search/package_show over a list of package dicts, with Solr-style fl results"""
+
+    def __init__(self, packages):
+        self.packages = sorted(packages, key=lambda package: package['id'])
+        self.calls = []
+
+    def package_search(self, fq=None, sort=None, start=0, rows=10, fl=None, fq_list=(), **kwargs):
+        self.calls.append('package_search')
+        results = self.packages
+        for term in fq_list:
+            since = term.split('[', 1)[1].split(' TO ')[0].rstrip('Z')
+            results = [package for package in results if package['metadata_modified'] > since]
+        page = results[start:start + rows]
+        if fl:
+            # Solr stores metadata_modified with a Z and millisecond precision
+            page = [{'id': package['id'], 'metadata_modified': package['metadata_modified'][:23] + 'Z'}
+                    for package in page]
+        return {'count': len(results), 'results': page}
+
+    def package_show(self, id):
+        self.calls.append('package_show')
+        return next(package for package in self.packages if package['id'] == id)
+
+
+def test_parse_modified_matches_solr_and_package_values():
+    assert h.same_modified('2026-01-02T03:04:56.789012', '2026-01-02T03:04:56.789Z')
+    assert h.same_modified('2026-01-02T03:04:56.700000', '2026-01-02T03:04:56.7Z')
+    assert h.same_modified('2026-01-02T03:04:56', '2026-01-02T03:04:56Z')
+    assert not h.same_modified('2026-01-02T03:04:56.789012', '2026-01-02T03:04:56.790Z')
+    assert not h.same_modified(None, '2026-01-02T03:04:56.789Z')
+
+
+def previous_snapshot(tmp_path, packages):
+    """A previous snapshot's datasets file and manifest holding packages"""
+
+    with h.RecordWriter(str(tmp_path / 'datasets.jsonl')) as out:
+        for package in packages:
+            out.write(package)
+    previous = {'packages': {
+        package['id']: {'type': 'dataset', 'metadata_modified': package['metadata_modified'], 'record': line}
+        for line, package in enumerate(packages)
+    }}
+    return out.path, previous
+
+
+def snapshot_packages():
+    return [
+        {'id': 'id-{}'.format(i), 'type': 'dataset', 'metadata_modified': '2026-01-0{}T00:00:00.123456'.format(i)}
+        for i in range(1, 4)
+    ]
+
+
+def test_incremental_snapshot_reuses_unchanged_datasets(tmp_path):
+    packages = snapshot_packages()
+    action = FakeAction(packages)
+    ctx = SimpleNamespace(obj={'twdh': SimpleNamespace(action=action), 'logecho': print, 'page_size': 10})
+    path, previous = previous_snapshot(tmp_path, packages)
+
+    with h.PreviousRecords(path) as previous_records:
+        results = list(h.snapshot_datasets(ctx, 'dataset', previous, previous_records))
+
+    assert [dataset for dataset, entry in results] == packages
+    assert all(entry is not None for dataset, entry in results)
+    assert 'package_show' not in action.calls
+
+
+def test_incremental_snapshot_fetches_what_the_previous_one_lacks(tmp_path):
+    packages = snapshot_packages()
+    action = FakeAction(packages)
+    ctx = SimpleNamespace(obj={'twdh': SimpleNamespace(action=action), 'logecho': print, 'page_size': 10})
+    path, previous = previous_snapshot(tmp_path, packages[:2])
+    previous['packages']['id-3'] = dict(previous['packages']['id-2'], record=2,
+                                        metadata_modified=packages[2]['metadata_modified'])
+
+    with h.PreviousRecords(str(tmp_path / 'missing.jsonl.gz')) as previous_records:
+        assert [dataset for dataset, entry in h.snapshot_datasets(ctx, 'dataset', previous, previous_records)] == packages
+    assert action.calls.count('package_show') == 3
+
+    action.calls.clear()
+    with h.PreviousRecords(path) as previous_records:
+        results = list(h.snapshot_datasets(ctx, 'dataset', previous, previous_records))
+    assert [dataset for dataset, entry in results] == packages
+    assert [entry is not None for dataset, entry in results] == [True, True, False]
+    assert action.calls.count('package_show') == 1
+
+
+def test_previous_records_reads_forward_only(tmp_path):
+    path, previous = previous_snapshot(tmp_path, snapshot_packages())
+
+    with h.PreviousRecords(path) as previous_records:
+        assert previous_records.read(0, 0) == []
+        assert [record['id'] for record in previous_records.read(1, 2)] == ['id-2', 'id-3']
+        assert previous_records.read(0, 1) is None
+        assert previous_records.read(3, 1) is None
+
+
+def test_limiter_ignores_jitter_on_fast_calls():
+    limiter = h.AdaptiveLimiter(8)
+    for seconds in [0.01, 0.2] * 20:
+        limiter.acquire()
+        limiter.release('package_search', seconds, False)
+    assert limiter.limit == 8
+
+
+def test_limiter_waits_for_samples_before_backing_off():
+    limiter = h.AdaptiveLimiter(8)
+    limiter.acquire()
+    limiter.release('package_show', 0.1, False)
+    limiter.acquire()
+    limiter.release('package_show', 2.0, False)
+    assert limiter.limit == 8
+
+
+def test_limiter_halves_on_slow_or_overloaded_calls():
+    limiter = h.AdaptiveLimiter(8)
+    for _ in range(h.AdaptiveLimiter.MIN_SAMPLES):
+        limiter.acquire()
+        limiter.release('package_show', 0.2, False)
+    limiter.acquire()
+    limiter.release('package_show', 2.0, False)
+    assert limiter.limit == 4
+
+    limiter = h.AdaptiveLimiter(8)
+    limiter.acquire()
+    limiter.release('package_patch', 0.1, True)
+    assert limiter.limit == 4
+
+
+def test_limiter_grows_back_to_max():
+    limiter = h.AdaptiveLimiter(4)
+    limiter.limit = 1.0
+    for _ in range(50):
+        limiter.acquire()
+        limiter.release('package_show', 0.01, False)
+    assert limiter.limit == 4
+
+
+def test_retry_after_seconds():
+    assert h.retry_after_seconds(None) == 0
+    assert h.retry_after_seconds('') == 0
+    assert h.retry_after_seconds('3') == 3
+    assert h.retry_after_seconds('-5') == 0
+    assert h.retry_after_seconds('not a date') == 0
+    assert h.retry_after_seconds('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    future = (datetime.now(timezone.utc) + timedelta(seconds=60)).strftime('%a, %d %b %Y %H:%M:%S GMT')
+    assert 55 < h.retry_after_seconds(future) <= 60
+
+
+def iter_results(doc, chunk, monkeypatch):
+    monkeypatch.setattr(h, 'JSON_CHUNK', chunk)
+    return list(h.iter_json_array(io.StringIO(doc), 'results'))
+
+
+@pytest.mark.parametrize('chunk', range(1, 12))
+def test_iter_json_array_numbers_across_chunk_boundaries(chunk, monkeypatch):
+    items = [12, 1.5, -0.25, 3e10, 1.5e-7, 1234567, 'a,b]', None, True, {'x': [1.0, 2]}]
+    doc = json.dumps({'count': 10, 'results': items, 'facets': {}})
+    assert iter_results(doc, chunk, monkeypatch) == items
+    assert iter_results(json.dumps({'results': items}, separators=(',', ':')), chunk, monkeypatch) == items
+
+
+def test_iter_json_array_empty_and_missing(monkeypatch):
+    assert iter_results('{"results": []}', 3, monkeypatch) == []
+    with pytest.raises(json.JSONDecodeError, match='No "results" array found'):
+        iter_results('{"count": 0}', 3, monkeypatch)
+
+
+def test_iter_json_array_reports_document_position(monkeypatch):
+    with pytest.raises(json.JSONDecodeError) as truncated:
+        iter_results('{"results": [', 4, monkeypatch)
+    assert truncated.value.pos == 13
+
+    with pytest.raises(json.JSONDecodeError) as malformed:
+        iter_results('{"a": 1,\n "results": [1, 2,\n  x]}', 4, monkeypatch)
+    assert (malformed.value.lineno, malformed.value.colno, malformed.value.pos) == (3, 3, 30)
+
+
+def test_diff_changes_keeps_only_differences():
+    dataset = {'id': 'x', 'title': 'Old', 'notes': None, 'extras': [{'key': 'placeKeywords', 'value': 'Travis'}]}
+    assert h.diff_changes(dataset, {'title': 'Old', 'notes': '', 'missing': None}) == {}
+    assert h.diff_changes(dataset, {'title': 'New', 'placeKeywords': 'Travis'}) == {'title': 'New'}
+    assert h.diff_changes(dataset, {'placeKeywords': 'Statewide'}) == {'placeKeywords': 'Statewide'}
+
+
+def test_diff_changes_sends_spatial_fields_together():
+    dataset = {'id': 'x', 'gazetteer': {'spatial_full': 'F', 'spatial_simp': 'S'}}
+    assert h.diff_changes(dataset, {'spatial_full': 'F', 'spatial_simp': 'S'}) == {}
+    assert h.diff_changes(dataset, {'spatial_simp': 'S2', 'spatial_full': 'F'}) == {'spatial_simp': 'S2', 'spatial_full': 'F'}
+    assert h.diff_changes(dataset, {'spatial_full': ''}) == {'spatial_full': '', 'spatial_simp': 'S'}
+
+
+def feature_collection(points=2000, closed=True):
+    ring = [[-97 + math.cos(2 * math.pi * i / points) * 0.1 + (i % 7) * 1e-7,
+             30 + math.sin(2 * math.pi * i / points) * 0.1] for i in range(points)]
+    if closed:
+        ring.append(ring[0])
+    return json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {'name': 'circle'}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}
+    ]})
+
+
+def test_simplify_to_size_fits_the_budget():
+    json_data = feature_collection()
+    json_str, messages = h.simplify_to_size(json_data, 4000)
+    assert h.utf8_len(json_str) <= 4000
+    assert json.loads(json_str)['features'][0]['properties'] == {'name': 'circle'}
+    assert 'Tolerance' in messages[-1][0]
+
+
+def test_simplify_to_size_rounds_before_simplifying():
+    json_data = feature_collection(200)
+    json_str, messages = h.simplify_to_size(json_data, h.utf8_len(json_data) - 1)
+    assert len(json.loads(json_str)['features'][0]['geometry']['coordinates'][0]) == 201
+    assert 'Precision: 6 digits' in messages[-1][0]
+
+
+def test_simplify_to_size_leaves_small_unreachable_or_invalid_input():
+    small = feature_collection(10)
+    assert h.simplify_to_size(small, 10 ** 6) == (small, [])
+    json_data = feature_collection()
+    assert h.simplify_to_size(json_data, 10)[0] is json_data
+    assert h.simplify_to_size('not json', 10)[0] == 'not json'
+
+
+def test_simplify_to_size_closes_rings():
+    json_str, messages = h.simplify_to_size(feature_collection(closed=False), 4000)
+    ring = json.loads(json_str)['features'][0]['geometry']['coordinates'][0]
+    assert ring[0] == ring[-1]
+
+
+def test_journal_resume_skips_completed_datasets(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    params = {'patch_fns': ['set_title']}
+    datasets = [{'id': 'id-{}'.format(i), 'name': 'ds-{}'.format(i)} for i in range(5)]
+
+    journal = h.Journal(path, params)
+    for dataset, outcome in zip(datasets, ['patched', 'identical', 'unchanged', 'failed']):
+        journal.record(dataset, outcome)
+    journal.close()
+    with open(path, 'a') as journal_file:
+        # Cut short by a killed run
+        journal_file.write('{"id": "id-4", "outc')
+
+    resumed = h.Journal(path, {'other': True})
+    assert resumed.params == params
+    assert [dataset['id'] for dataset in resumed.pending(datasets)] == ['id-3', 'id-4']
+    assert resumed.pending_count(5) == 2
+    resumed.record(datasets[3], 'patched')
+    resumed.close()
+
+    with open(path) as journal_file:
+        assert json.loads(journal_file.readlines()[-1])['id'] == 'id-3'
+    reopened = h.Journal(path, params)
+    reopened.close()
+    assert reopened.completed == {'id-0', 'id-1', 'id-2', 'id-3'}
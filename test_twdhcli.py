@@ -0,0 +1,72 @@
+import json
+from types import SimpleNamespace
+
+from click.testing import CliRunner
+
+import helpers as h
+import twdhcli
+
+
+class FakeCKAN:
+    """The parts of RetryingCKAN twdhcli uses, over a list of package dicts"""
+
+    def __init__(self, packages):
+        self.packages = packages
+        self.patched = []
+        self.retried = 0
+        self.limiter = SimpleNamespace(limit=1)
+        self.session = h.make_session(1)
+        self.action = SimpleNamespace(
+            package_search=self.package_search,
+            package_show=self.package_show,
+            package_patch=self.package_patch,
+        )
+
+    def package_search(self, start=0, rows=10, include_deleted=False, fq=None, **kwargs):
+        package_type = fq.split(':', 1)[1]
+        results = [package for package in self.packages
+                   if package['type'] == package_type and (include_deleted or package['state'] != 'deleted')]
+        return {'count': len(results), 'results': results[start:start + rows]}
+
+    def package_show(self, id):
+        return next(package for package in self.packages if id in (package['id'], package['name']))
+
+    def package_patch(self, id, **changes):
+        self.patched.append(id)
+        package = self.package_show(id)
+        package['gazetteer'] = dict(package['gazetteer'], **changes)
+        return package
+
+    def close(self):
+        self.session.close()
+
+
+def gazetteer(n):
+    spatial = json.dumps({'type': 'FeatureCollection', 'features': [], 'n': n})
+    return {'spatial_full': spatial, 'spatial_simp': spatial}
+
+
+def test_restore_spatial_twice_patches_only_once(tmp_path, monkeypatch):
+    packages = [
+        {'id': 'id-1', 'name': 'active', 'type': 'dataset', 'state': 'active', 'gazetteer': gazetteer(1)},
+        {'id': 'id-2', 'name': 'deleted', 'type': 'dataset', 'state': 'deleted', 'gazetteer': gazetteer(2)},
+    ]
+    snapshot_file = tmp_path / 'datasets.jsonl'
+    snapshot_file.write_text(''.join(json.dumps(package) + '\n' for package in packages))
+
+    packages = [dict(packages[0], gazetteer=gazetteer(10)), dict(packages[1])]
+    remote = FakeCKAN(packages)
+    monkeypatch.setattr(h, 'RetryingCKAN', lambda *args, **kwargs: remote)
+    monkeypatch.chdir(tmp_path)
+
+    args = ['--host', 'http://ckan.test', '--apikey', 'x', '--logfile', str(tmp_path / 'twdhcli.log'),
+            'restore-spatial', '--patch-file', str(snapshot_file)]
+
+    first = CliRunner().invoke(twdhcli.twdhcli, args, input='y\n', obj={})
+    assert first.exit_code == 0, first.output
+    assert remote.patched == ['id-1']
+
+    second = CliRunner().invoke(twdhcli.twdhcli, args, input='y\n', obj={})
+    assert second.exit_code == 0, second.output
+    assert remote.patched == ['id-1']
+    assert '0 restored / 2 unchanged' in second.output
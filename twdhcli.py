@@ -2,7 +2,6 @@ from __future__ import annotations
 from colorama import init, Fore, Back, Style
 import click
 import click_config_file
-import ckanapi
 import requests
 import os
 import sys
@@ -11,10 +10,16 @@ from dotenv import dotenv_values
 from datetime import datetime, date
 from time import perf_counter
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 import csv
 from pathlib import Path
 from urllib.parse import urlparse
 import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 
 import helpers as h
 
@@ -29,18 +34,51 @@ FORMAT = '%(message)s'
 
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting records to the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+
 def setup_logger(name, log_file, level=logging.INFO):
 
     handler = logging.FileHandler(log_file)
     handler.setFormatter(formatter)
 
+    # Records are written to the file by a background thread, so logging
+    # never blocks the command on disk I/O
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(handler)
+    logger.addHandler(DeferredQueueHandler(log_queue))
 
     return logger
 
 
+# logecho level: (logfile level or None, console prefix, echo to stderr)
+LOG_LEVELS = {
+    'error': (logging.ERROR, Fore.RED + '🔴 ', True),
+    'warning': (logging.WARNING, Fore.YELLOW + '🟡 ' + Fore.WHITE, False),
+    'debug': (logging.DEBUG, '🟢🟢 ' + Fore.WHITE, False),
+    'note': (logging.DEBUG, '🟢 ' + Fore.GREEN, False),
+    'detail': (logging.DEBUG, '🔵 ' + Fore.BLUE, False),
+    'info': (logging.DEBUG, '⚪️ ' + Fore.WHITE, False),
+    'exit': (logging.DEBUG, '⚫️ ' + Fore.WHITE, False),
+    'celebration': (logging.DEBUG, '🎉 ' + Fore.MAGENTA, False),
+    'divider': (None, '🟣 ' + Fore.MAGENTA, False),
+}
+
+# Levels kept off the console while a --progress bar is drawn
+PROGRESS_HIDDEN = ('info', 'detail', 'note', 'divider')
+
+DIVIDER = '-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-'
+
+
 def get_patch_functions():
     return  {
         'example': patch_fn_example,
@@ -80,9 +118,42 @@ def get_patch_functions():
               default='./twdhcli.log',
               show_default=True,
               help='The full path of the main log file.')
+@click.option('--page-size',
+              type=click.IntRange(min=1),
+              default=h.PAGE_SIZE,
+              show_default=True,
+              help='Number of datasets requested per package_search page.')
+@click.option('--concurrency',
+              type=click.IntRange(min=1),
+              default=h.CONCURRENCY,
+              show_default=True,
+              help='Maximum number of concurrent API calls for per-resource and per-dataset work.')
+@click.option('--retries',
+              type=click.IntRange(min=0),
+              default=h.RETRIES,
+              show_default=True,
+              help='Times an idempotent API call is retried when CKAN is overloaded or unreachable.')
+@click.option('--timeout',
+              type=click.FloatRange(min=0, min_open=True),
+              default=h.READ_TIMEOUT,
+              show_default=True,
+              help='Seconds to wait for the response to an API call.')
+@click.option('--local',
+              is_flag=True,
+              default=False,
+              help='Answer read-only commands from the local mirror kept up to date by sync.')
+@click.option('--mirror',
+              type=click.Path(),
+              default='./twdh-mirror.sqlite',
+              show_default=True,
+              help='The full path of the local mirror database.')
+@click.option('--progress',
+              is_flag=True,
+              default=False,
+              help='Show a progress bar instead of per-dataset lines, which still go to --logfile.')
 @click.version_option(version)
 @click.pass_context
-def twdhcli(ctx, host, apikey, test_run, quiet, debug, logfile):
+def twdhcli(ctx, host, apikey, test_run, quiet, debug, logfile, page_size, concurrency, retries, timeout, local, mirror, progress):
     """\b
        __               ____         ___
       / /__      ______/ / /_  _____/ (_)
@@ -94,44 +165,35 @@ def twdhcli(ctx, host, apikey, test_run, quiet, debug, logfile):
     """
 
     logger = setup_logger('mainlogger', logfile,
-                          logging.DEBUG if debug else logging.INFO)
-
-    def logecho(message, level='info'):
-        """helper for logging to file and console"""
-        if level == 'error':
-            logger.error(message)
-            click.echo(Fore.RED + '🔴 ' + 
-                message, err=True) if not quiet else True
-        elif level == 'warning':
-            logger.warning(message)
-            click.echo(Fore.YELLOW + '🟡 ' +
-                Fore.WHITE + message) if not quiet else True
-        elif level == 'debug':
-            logger.debug(message)
-            click.echo('🟢🟢 ' +
-                Fore.WHITE + message) if debug else False
-        elif level == 'note':
-            logger.debug(message)
-            click.echo('🟢 ' +
-                Fore.GREEN + message) if not quiet else True
-        elif level == 'detail':
-            logger.debug(message)
-            click.echo('🔵 ' +
-                Fore.BLUE + message) if not quiet else True
-        elif level == 'info':
-            logger.debug(message)
-            click.echo('⚪️ ' + Fore.WHITE + message) if not quiet else True
-        elif level == 'exit':
-            logger.debug(message)
-            click.echo('⚫️ ' + Fore.WHITE + message) if not quiet else True
-        elif level == 'celebration':
-            logger.debug(message)
-            click.echo('🎉 ' + Fore.MAGENTA + message) if not quiet else True
-        elif level == 'divider':
-            click.echo('🟣 ' + Fore.MAGENTA + '-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-=+=-') if not quiet else True
+                          logging.DEBUG if debug or progress else logging.INFO)
+
+    progress_active = threading.Event()
+
+    def logecho(message, level='info', *args, detail=None):
+        """
+        helper for logging to file and console. message is formatted with
+        args only when it is going to be written somewhere. detail, when
+        given, is logged to the file in place of message.
+        """
+        log_level, prefix, to_stderr = LOG_LEVELS.get(level, (logging.INFO, Fore.GREEN, False))
+
+        if level == 'debug':
+            echo = debug
         else:
-            logger.info(message)
-            click.echo(Fore.GREEN + message) if not quiet else True
+            echo = not quiet and not (progress_active.is_set() and level in PROGRESS_HIDDEN)
+        log = log_level is not None and logger.isEnabledFor(log_level)
+
+        if not (echo or log):
+            return
+        if level == 'divider':
+            message = DIVIDER
+        elif args:
+            message = message.format(*args)
+
+        if log:
+            logger.log(log_level, message if detail is None else detail)
+        if echo:
+            click.echo(prefix + str(message), err=to_stderr)
 
     logecho('Starting twdhcli/%s ...' % version, 'detail')
 
@@ -157,8 +219,13 @@ def twdhcli(ctx, host, apikey, test_run, quiet, debug, logfile):
 
     # log into CKAN
     try:
-        twdh = ckanapi.RemoteCKAN(host, apikey=apikey,
-                            user_agent='twdhcli/' + version)
+        twdh = h.RetryingCKAN(host, apikey=apikey,
+                            user_agent='twdhcli/' + version,
+                            session=h.make_session(concurrency, 'twdhcli/' + version),
+                            retries=retries,
+                            max_concurrency=concurrency,
+                            logecho=logecho,
+                            timeout=(h.CONNECT_TIMEOUT, timeout))
     except Exception as e:
         logecho('Cannot connect to host %s' % host, level='error')
         sys.exit()
@@ -167,7 +234,29 @@ def twdhcli(ctx, host, apikey, test_run, quiet, debug, logfile):
 
     ctx.obj['twdh'] = twdh
     ctx.obj['logecho'] = logecho
+
+    @ctx.call_on_close
+    def log_client_stats():
+        requests_made, connections = h.session_stats(twdh.session)
+        logecho("{} API requests over {} connections ({} reused), {} retried, concurrency limit ended at {}".format(
+            requests_made, connections, requests_made - connections, twdh.retried, int(twdh.limiter.limit)), "debug")
+        twdh.close()
+
     ctx.obj['test_run'] = test_run
+    ctx.obj['page_size'] = page_size
+    ctx.obj['concurrency'] = concurrency
+    ctx.obj['mirror_path'] = mirror
+    ctx.obj['local'] = local
+    ctx.obj['progress'] = progress
+    ctx.obj['progress_active'] = progress_active
+
+    if local:
+        if not os.path.exists(mirror):
+            logecho("Cannot continue: mirror {} not found, run sync first".format(mirror), "error")
+            exit(1)
+        ctx.obj['mirror'] = h.Mirror(mirror)
+        logecho("Reading datasets from mirror {} (synced {})".format(
+            mirror, ctx.obj['mirror'].get_meta('synced')), "detail")
 
 @twdhcli.command()
 @click.option('--dest',
@@ -175,19 +264,56 @@ def twdhcli(ctx, host, apikey, test_run, quiet, debug, logfile):
               default='./twdh-snapshots',
               show_default=True,
               help='The full path of the CSV output file.')
+@click.option('--incremental',
+              default=False,
+              is_flag=True,
+              help='Only fetch datasets modified since the previous snapshot in --dest')
+@click.option('--compression',
+              type=click.Choice(list(h.COMPRESSION_SUFFIXES)),
+              default='gzip',
+              show_default=True,
+              help='Compression of the snapshot JSONL files (zstd needs the zstandard package)')
 @click.pass_context
-def snapshot(ctx,dest):
+def snapshot(ctx,dest,incremental,compression):
     """
     Create JSON snapshot files for datasets, applications and organizations
     """
-    h.snapshot(ctx,dest)
+    h.require_live(ctx)
+    h.snapshot(ctx,dest,incremental,compression)
+
+
+@twdhcli.command()
+@click.option('--full',
+              default=False,
+              is_flag=True,
+              help='Fetch every package again instead of only those modified since the last sync')
+@click.pass_context
+def sync(ctx,full):
+    """
+    Update the local mirror of package metadata used by --local
+    """
+
+    logecho = ctx.obj['logecho']
+
+    h.require_live(ctx)
+
+    time_start = perf_counter()
+    mirror = h.Mirror(ctx.obj['mirror_path'])
+    try:
+        results = h.sync(ctx, mirror, full)
+    finally:
+        mirror.close()
+
+    for package_type, (updated, removed) in results.items():
+        logecho( "{} {}s updated, {} removed".format(updated, package_type, removed), 'info' )
+    logecho( "Synced {} in {} seconds".format(ctx.obj['mirror_path'], round(perf_counter() - time_start, 2)), 'celebration' )
 
 
 @twdhcli.command()
-@click.option('--patch-fn',
+@click.option('--patch-fn', 'patch_fns',
               required=True,
-              default=None,
-              help='patch function to apply')
+              multiple=True,
+              help='patch function to apply, repeat to apply several in one package_patch per dataset')
 @click.option('--ids',
               required=False,
               default=None,
@@ -212,36 +338,56 @@ def snapshot(ctx,dest):
               default=False,
               is_flag=True,
               help='Don\'t bail out on errors when processing multiple datasets')
+@click.option('--workers',
+              type=click.IntRange(min=1),
+              default=1,
+              show_default=True,
+              help='Number of datasets to patch concurrently')
+@click.option('--journal',
+              type=click.Path(dir_okay=False),
+              default=None,
+              help='File recording the outcome of each dataset, by default a new file in ./twdh-journals')
+@click.option('--resume',
+              type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help='Journal of an interrupted run: skip the datasets it completed and append to it')
 @click.pass_context
-def patch_datasets(ctx, patch_fn, ids, patch_data, dataset_type, confirm_each, skip_snapshot, force):
+def patch_datasets(ctx, patch_fns, ids, patch_data, dataset_type, confirm_each, skip_snapshot, force, workers, journal, resume):
     """
     Patch datasets
     """
 
     ctx.obj['force'] = force
 
-    twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
+
+    h.require_live(ctx)
 
     patch_fn_dict = get_patch_functions()
 
-    if patch_fn not in patch_fn_dict:
-        logecho( "Patch function does not exist: {}".format(patch_fn), "info" )
-        return
+    for patch_fn in patch_fns:
+        if patch_fn not in patch_fn_dict:
+            logecho( "Patch function does not exist: {}".format(patch_fn), "info" )
+            return
 
     if force:
         logecho( "Force enabled, patch_datasets will continue processing after running into an error", "warning" )
 
-    if not skip_snapshot and click.confirm('🟢 Take a snapshot before running patches?', default=True):
-        h.snapshot( ctx, './twdh-snapshots' )
+    journal = h.open_journal(ctx, 'patch_datasets', {'patch_fns': list(patch_fns), 'patch_data': patch_data,
+                             'dataset_type': dataset_type, 'ids': ids}, journal, resume)
+
+    if resume:
+        logecho( "Skipped snapshot, it was taken before the resumed run", "warning" )
+    elif not skip_snapshot and click.confirm('🟢 Take a snapshot before running patches?', default=True):
+        h.snapshot( ctx, './twdh-snapshots', incremental=True )
     else:
         logecho( "Skipped snapshot!", "warning" )
 
-    datasets = h.fetch_datasets(ctx, ids, dataset_type)
+    datasets = journal.pending(h.fetch_datasets(ctx, ids, dataset_type))
 
     # Confirm patch operation
     if ids:
+        datasets = list(datasets)
         logecho( "Prepared to patch the following datasets", 'warning')
         for dataset in datasets:
             logecho( "- {} ({})".format(dataset.get("title"),dataset.get("id")), 'info')
@@ -253,7 +399,7 @@ def patch_datasets(ctx, patch_fn, ids, patch_data, dataset_type, confirm_each, s
                 sys.exit(0)
     else:
         if not confirm_each:
-            if click.confirm('🟢 Proceed with patching {} {}s?'.format(len(datasets), dataset_type)):
+            if click.confirm('🟢 Proceed with patching {} {}s?'.format(journal.pending_count(h.count_datasets(ctx, ids, dataset_type)), dataset_type)):
                 logecho( "Proceeding with patches ...", "info" )
             else: 
                 logecho( "Operation cancelled", "exit" )
@@ -272,41 +418,157 @@ def patch_datasets(ctx, patch_fn, ids, patch_data, dataset_type, confirm_each, s
         data_dict = {}
         logecho( "Patch data is an empty dict", "warning" )
 
-    c = 0
-    for dataset in datasets:
-        c += 1
-        logecho( "{}) About to patch {} ({})".format(c,dataset.get("title"),dataset.get("id")), 'info')
-        if confirm_each:
-            if click.confirm('🟢 Proceed with patch?'):
-                logecho( "Proceeding with patch ...", "info" )
-            else: 
-                logecho( "Patch cancelled", "warning" )
-                continue
-        try:
-            # Run patch function
-            if patch_fn_dict[patch_fn](ctx,dataset,data_dict):
-                logecho( "... patched", 'info')
-            elif test_run:
-                logecho( "... patched skipped by test_run", 'info')
-            else:
-                logecho( "... patched failed", 'info')
+    if workers > 1 and confirm_each:
+        logecho( "--confirm-each patches one dataset at a time, ignoring --workers", "warning" )
+        workers = 1
 
-        except Exception as e:
-            logecho( e, 'error' )
+    concurrency = ctx.obj.get('concurrency') or h.CONCURRENCY
+    if workers > concurrency:
+        logecho( "--workers {} is more than --concurrency {}: at most {} CKAN calls are made at a time".format(workers, concurrency, concurrency), "warning" )
 
-def patch_fn_example(ctx,dataset,data):
+    def patch_serially():
+        c = 0
+        for dataset in datasets:
+            c += 1
+            logecho( "{}) About to patch {} ({})", 'info', c, dataset.get("title"), dataset.get("id"))
+            if confirm_each:
+                if click.confirm('🟢 Proceed with patch?'):
+                    logecho( "Proceeding with patch ...", "info" )
+                else: 
+                    logecho( "Patch cancelled", "warning" )
+                    yield dataset, 'cancelled'
+                    continue
+            yield dataset, run_patch(ctx, patch_fns, dataset, data_dict)
+
+    def patch_concurrently():
+
+        def patch(dataset):
+            worker_ctx, messages = h.buffered_ctx(ctx)
+            return run_patch(worker_ctx, patch_fns, dataset, data_dict), messages
+
+        c = 0
+        for dataset, future in h.bounded_map(patch, datasets, workers, stop=stop):
+            c += 1
+            outcome, messages = future.result()
+            logecho( "{}) About to patch {} ({})", 'info', c, dataset.get("title"), dataset.get("id"))
+            for message, level in messages:
+                logecho( message, level )
+            yield dataset, outcome
+
+    stop = threading.Event()
+    summary = {'patched': 0, 'identical': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0, 'cancelled': 0}
+    start = perf_counter()
+
+    try:
+        for dataset, outcome in (patch_concurrently() if workers > 1 else patch_serially()):
+            journal.record(dataset, outcome)
+            summary[outcome] += 1
+            if outcome == 'failed' and not force and not stop.is_set():
+                logecho( "Bailing out: enable --force to prevent bailouts", 'error' )
+                stop.set()
+                if workers == 1:
+                    break
+    finally:
+        journal.close()
+
+    logecho( "", "divider" )
+    logecho( "{patched} patched / {identical} identical / {unchanged} unchanged / {skipped} skipped / {failed} failed / {cancelled} cancelled".format(**summary), "info" )
+    if summary['identical']:
+        logecho( "{} package_patch calls saved on datasets that already had the patched values".format(summary['identical']), "info" )
+    logecho( "Finished in {}s".format(round(perf_counter() - start, 2)), "info" )
+
+    if stop.is_set():
+        sys.exit(1)
+
+def run_patch(ctx, patch_fns, dataset, data_dict):
+    """
+    Run patch functions against one dataset and send their changes as a
+    single package_patch. Reports the outcome as 'patched', 'unchanged'
+    (the patch functions had nothing to patch), 'identical' (the dataset
+    already has the patched values, so the call is saved), 'skipped'
+    (test run) or 'failed'
+    """
+
+    logecho = ctx.obj['logecho']
+    test_run = ctx.obj['test_run']
+
+    try:
+        changes, touch = collect_changes(ctx, patch_fns, dataset, data_dict)
+        if changes is None:
+            logecho( "... nothing to patch", 'info')
+            return 'unchanged'
+        if not changes and not touch:
+            logecho( "... already has the patched values", 'info')
+            return 'identical'
+
+        if test_run:
+            if not changes:
+                logecho( "  no field changes, patch only re-validates", 'info')
+            for field, value in changes.items():
+                logecho( "  {}: {} -> {}".format(field, h.preview(h.current_value(dataset, field)), h.preview(value)), 'info')
+
+        if apply_patch(ctx, dataset, changes):
+            logecho( "... patched", 'info')
+            return 'patched'
+        elif test_run:
+            logecho( "... patched skipped by test_run", 'info')
+            return 'skipped'
+        else:
+            logecho( "... patched failed", 'info')
+            return 'failed'
+
+    except Exception as e:
+        logecho( e, 'error' )
+        return 'failed'
+
+def collect_changes(ctx, patch_fns, dataset, data):
+    """
+    Merge the changes of several patch functions into one package_patch
+    data dict holding only the fields whose values differ from dataset.
+    Each function sees the dataset with the changes of the ones before it.
+
+    Returns the changes, None when no function had anything to patch,
+    and whether a function asked for the dataset to be touched even if
+    nothing differs by returning {} itself.
+    """
+
+    logecho = ctx.obj['logecho']
+    patch_fn_dict = get_patch_functions()
+
+    merged = None
+    touch = False
+    for patch_fn in patch_fns:
+        changes = patch_fn_dict[patch_fn](ctx, dict(dataset, **(merged or {})), data)
+        if changes is None:
+            continue
+        if not changes:
+            touch = True
+        for field, value in changes.items():
+            if merged and field in merged and merged[field] != value:
+                logecho( "{} overrides {} set by an earlier patch function".format(patch_fn, field), 'warning')
+        merged = dict(merged or {}, **changes)
+
+    if merged is None:
+        return None, touch
+
+    return h.diff_changes(dataset, merged), touch
+
+def apply_patch(ctx, dataset, changes):
+    """
+    Send changes to a dataset as one package_patch. An empty dict still
+    makes the call, which re-validates and re-indexes the dataset.
+    Returns False on a test run or when the call fails.
+    """
 
     remote = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
     test_run = ctx.obj['test_run']
 
     try:
-        logecho('This is an example patch function', 'info')    
-        
         if test_run:
             return False
 
-        # Call action here
+        remote.action.package_patch( id=dataset.get("id"), **changes )
 
     except Exception as e:
         if str(e) == 'Not found':
@@ -318,15 +580,26 @@ def patch_fn_example(ctx,dataset,data):
 
     return True
 
+def patch_fn_example(ctx,dataset,data):
+    """
+    Patch functions return a dict of fields to patch, {} to patch nothing
+    but still touch the dataset, or None when the dataset needs no patch.
+    """
+
+    logecho = ctx.obj['logecho']
+
+    logecho('This is an example patch function', 'info')
+
+    # Return changes here, e.g. { 'title': data['title'] }
+    return None
+
 
 def patch_fn_fix_place_keywords(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
 
     extras = dataset.get("extras",{})
-    found = False
+    changes = None
     for extra in extras:
         if extra.get('key') == 'placeKeywords':
             place_keywords = extra.get('value','')
@@ -335,20 +608,8 @@ def patch_fn_fix_place_keywords(ctx,dataset,data):
             if place_keywords == 'Statewide':
                 place_keywords = 'Texas'
 
-            try:
-                if test_run:
-                    return False
+            changes = { 'place_keywords': "{}".format( place_keywords ) }
 
-                remote.action.package_patch( id=dataset.get("id"), place_keywords="{}".format( place_keywords ) )
-
-            except Exception as e:
-                if str(e) == 'Not found':
-                    logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-                    return False
-                else:
-                    logecho("Error: {}".format(e), 'error')
-                    return False
-            
             """
             if dataset.get('place_keywords'):
                 logecho( "place_keywords={}".format( dataset.get("place_keywords") ) )
@@ -360,170 +621,69 @@ def patch_fn_fix_place_keywords(ctx,dataset,data):
             else:
                 logecho( "No gazetteer place_keywords" )
             """
-                
-            found = True
 
-    return True
+    return changes
 
 def patch_fn_validate_datasets(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
-    logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
-    force = ctx.obj['force']
-
-    try:
-        if test_run:
-            return False
-
-        remote.action.package_patch( id=dataset.get("id") )
-
-    except Exception as e:
-        logecho( "Dataset {} does not validate: {}".format( dataset['name'], e ), 'error' )
-        if not force:
-            logecho( "Bailing out: enable --force to prevent bailouts", 'error' )
-            sys.exit(1)
-
-    return True
+    # An empty patch makes CKAN validate and re-index the dataset
+    return {}
 
 
 def patch_fn_fix_empty_date_ranges(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
 
     if 'date_range' in dataset:
         logecho( dataset['date_range'], 'info' )
         logecho( 'Date range exists, skipping ...', 'info' )
-    else:
-        logecho( 'No date range!', 'info' )
+        return None
 
-        try:
-            if test_run:
-                return False
-
-            remote.action.package_patch( id=dataset.get("id"), date_range="no date range" )
-
-        except Exception as e:
-            if str(e) == 'Not found':
-                logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-                return False
-            else:
-                logecho("Error: {}".format(e), 'error')
-                return False
-    return True
+    logecho( 'No date range!', 'info' )
+    return { 'date_range': "no date range" }
 
 def patch_fn_fix_empty_date_ranges_and_update_types(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
 
     if 'date_range' in dataset:
         logecho( dataset['date_range'], 'info' )
         logecho( 'Date range exists, skipping ...', 'info' )
-    else:
-        logecho( 'No date range!', 'info' )
-
-        try:
-            if test_run:
-                return False
+        return None
 
-            remote.action.package_patch( id=dataset.get("id"), date_range="no date range", update_type="none", primary_tags = 'administrative', tag_string='administrative' )
-
-        except Exception as e:
-            if str(e) == 'Not found':
-                logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-                return False
-            else:
-                logecho("Error: {}".format(e), 'error')
-                return False
-    return True
+    logecho( 'No date range!', 'info' )
+    return { 'date_range': "no date range", 'update_type': "none", 'primary_tags': 'administrative', 'tag_string': 'administrative' }
 
 
 def patch_fn_fix_empty_date_ranges_and_collection_methods(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
 
     if 'date_range' in dataset:
         logecho( dataset['date_range'], 'info' )
         logecho( 'Date range exists, skipping ...', 'info' )
-    else:
-        logecho( 'No date range!', 'info' )
+        return None
 
-        try:
-            if test_run:
-                return False
-
-            remote.action.package_patch( id=dataset.get("id"), date_range="no date range", collection_method="survey" )
-
-        except Exception as e:
-            if str(e) == 'Not found':
-                logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-                return False
-            else:
-                logecho("Error: {}".format(e), 'error')
-                return False
-    return True
+    logecho( 'No date range!', 'info' )
+    return { 'date_range': "no date range", 'collection_method': "survey" }
 
 
 def patch_fn_clear_spatial_data(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
-    logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
-
-    try:
-        if test_run:
-            return False
-
-        remote.action.package_patch( id=dataset.get("id"), gazetteer="" )
-
-    except Exception as e:
-        if str(e) == 'Not found':
-            logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-            return False
-        else:
-            logecho("Error: {}".format(e), 'error')
-            return False
-
-    return True
+    return { 'gazetteer': "" }
     
 def patch_fn_clear_spatial_data_full(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
-    logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
-
-    try:
-        if test_run:
-            return False
-
-        gazetteer = dataset.get('gazetteer', {})
-        if 'spatial_full' in gazetteer:
-            gazetteer['spatial_full'] = ""
-
-        remote.action.package_patch( id=dataset.get("id"), spatial_simp=gazetteer['spatial_simp'], spatial_full=gazetteer['spatial_full'] )
-
-    except Exception as e:
-        if str(e) == 'Not found':
-            logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-            return False
-        else:
-            logecho("Error: {}".format(e), 'error')
-            return False
+    gazetteer = dict(dataset.get('gazetteer') or {})
+    if 'spatial_full' in gazetteer:
+        gazetteer['spatial_full'] = ""
 
-    return True
+    return { 'spatial_simp': gazetteer['spatial_simp'], 'spatial_full': gazetteer['spatial_full'] }
 
 
 def patch_fn_set_spatial_data(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
 
     try:
         spatial_simp = data.get('spatial_simp', '{}')
@@ -539,121 +699,48 @@ def patch_fn_set_spatial_data(ctx,dataset,data):
     except json.JSONDecodeError as e:
         logecho(f"JSON parsing error on spatial_full: {e}, value: {spatial_full}",'error')
 
-    try:
-        if test_run:
-            return False
-
-        remote.action.package_patch( id=dataset.get("id"), spatial_simp=spatial_simp, spatial_full=spatial_full )
-
-    except Exception as e:
-        if str(e) == 'Not found':
-            logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-            return False
-        else:
-            logecho("Error: {}".format(e), 'error')
-            return False
-
-    return True
+    return { 'spatial_simp': spatial_simp, 'spatial_full': spatial_full }
 
 def patch_fn_clear_data_dictionary(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
-    logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
-
-    try:
-        if test_run:
-            return False
-
-        remote.action.package_patch( id=dataset.get("id"), data_dictionary="" )
-
-    except Exception as e:
-        if str(e) == 'Not found':
-            logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-            return False
-        else:
-            logecho("Error: {}".format(e), 'error')
-            return False
-
-    return True
+    return { 'data_dictionary': "" }
 
 
 def patch_fn_set_title(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
-    logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
-
-    try:
-        if test_run:
-            return False
-
-        remote.action.package_patch( id=dataset.get("id"), title=data['title'] )
-
-    except Exception as e:
-        if str(e) == 'Not found':
-            logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-            return False
-        else:
-            logecho("Error: {}".format(e), 'error')
-            return False
-
-    return True
+    return { 'title': data['title'] }
 
 def patch_fn_set_app_email(ctx,dataset,data):
 
-    remote = ctx.obj['twdh']
-    logecho = ctx.obj['logecho']
-    test_run = ctx.obj['test_run']
-
-    try:
-        if test_run:
-            return False
-
-        remote.action.package_patch( id=dataset.get("id"), data_contact_email=data['email'] )
-
-    except Exception as e:
-        if str(e) == 'Not found':
-            logecho( "Error: dataset {} not found".format(dataset.get("id")), 'error')
-            return False
-        else:
-            logecho("Error: {}".format(e), 'error')
-            return False
-
-    return True
+    return { 'data_contact_email': data['email'] }
 
 
 @twdhcli.command()
 @click.option('--patch-file',
               required=True,
               default=None,
-              help='JSON file containing patch data')
+              help='Snapshot file containing patch data: datasets.json, or datasets.jsonl optionally compressed (.gz, .zst)')
+@click.option('--ids',
+              required=False,
+              default=None,
+              help='list of dataset ids or names to restore, all datasets in the file by default')
 @click.option('--confirm-each',
               default=False,
               is_flag=True,
               help='Confirm each patch operation instead of just once at the start')
 @click.pass_context
-def restore_spatial(ctx, patch_file, confirm_each):
+def restore_spatial(ctx, patch_file, ids, confirm_each):
     """
     Restore spatial data to datasets
     """
 
-    twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
-    try:
-        with open(patch_file, "r") as file:
-            patch_data = json.load(file)
-    except FileNotFoundError:
+    h.require_live(ctx)
+
+    if not os.path.exists(patch_file):
         logecho("Error: The file was not found.", 'error')
         sys.exit(1)
-    except json.JSONDecodeError as e:
-        logecho(f"Error: Could not decode JSON from '{patch_file}'. Check if the file contains valid JSON.", 'error')
-        logecho( f"{e}", 'error' )
-        sys.exit(1)
-    except Exception as e:
-        logecho(f"An unexpected error occurred: {e}", 'error')
-        sys.exit(1)
     logecho( "Restoring spatial data from {} ...".format(patch_file), "info" )
 
     if not confirm_each:
@@ -667,39 +754,72 @@ def restore_spatial(ctx, patch_file, confirm_each):
     else:
         confirm_all = True
 
-    for dataset in patch_data['results']:
+    logecho( "Fetching live spatial data to compare ...", "info" )
+    live = h.live_spatial_hashes(ctx, ids)
 
-        logecho( "", "divider" )
+    summary = {'restored': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0, 'cancelled': 0}
 
-        run_patch = True
+    def candidates():
+        # Datasets from the file whose spatial data differs from the live dataset
+        for dataset in h.read_records(patch_file, ids.split() if ids else None):
 
-        if 'gazetteer' in dataset:
+            if 'gazetteer' not in dataset:
+                logecho( "No gazetteer attribute found for \"{}\"".format(dataset['name']), "info" )
+                continue
 
             spatial_full = dataset['gazetteer'].get('spatial_full', None)
             spatial_simp = dataset['gazetteer'].get('spatial_simp', None)
 
-            if spatial_full != None or spatial_simp != None:
+            if spatial_full == None and spatial_simp == None:
+                logecho( "No spatial data found for \"{}\"".format(dataset['name']), "info" )
+                continue
 
-                logecho( "Spatial data found for dataset \"{}\"".format(dataset['name']), "info" )
+            if live.get(dataset['id']) == h.spatial_hash(dataset['gazetteer']):
+                logecho( "Spatial data unchanged for \"{}\"".format(dataset['name']), "info" )
+                summary['unchanged'] += 1
+                continue
 
-                if confirm_all:
-                    if click.confirm("🟢 Proceed to patch dataset \"{}\"? ".format(dataset['name']), abort=False, default=True):
-                        run_patch = True
-                    else: 
-                        logecho( "Patch cancelled", "warning" )
-                        run_patch = False
+            if confirm_all:
+                if not click.confirm("🟢 Proceed to patch dataset \"{}\"? ".format(dataset['name']), abort=False, default=True):
+                    logecho( "Patch cancelled", "warning" )
+                    summary['cancelled'] += 1
+                    continue
 
-                if run_patch:
-                    if patch_fn_set_spatial_data( ctx, dataset, dataset.get('gazetteer', None)):
-                        logecho( "... patched", "info" )
-                    else:
-                        logecho( "Error patching dataset \"{}\"".format(dataset['name']), "info" )
+            yield dataset
 
-            else:
-                logecho( "No spatial data found for \"{}\"".format(dataset['name']), "info" )
+    def restore(dataset):
+        worker_ctx, messages = h.buffered_ctx(ctx)
+        logecho = worker_ctx.obj['logecho']
 
-        else:
-            logecho( "No gazetteer attribute found for \"{}\"".format(dataset['name']), "info" )
+        logecho( "Spatial data differs for dataset \"{}\"".format(dataset['name']), "info" )
+        if apply_patch( worker_ctx, dataset, patch_fn_set_spatial_data( worker_ctx, dataset, dataset['gazetteer'] ) ):
+            logecho( "... patched", "info" )
+            return 'restored', messages
+        if ctx.obj['test_run']:
+            logecho( "... patched skipped by test_run", "info" )
+            return 'skipped', messages
+        logecho( "Error patching dataset \"{}\"".format(dataset['name']), "info" )
+        return 'failed', messages
+
+    # One at a time when confirming each, so prompts and results alternate
+    workers = 1 if confirm_all else ctx.obj.get('concurrency') or h.CONCURRENCY
+    start = perf_counter()
+
+    try:
+        for dataset, future in h.bounded_map(restore, candidates(), workers, in_flight=1 if confirm_all else None):
+            outcome, messages = future.result()
+            for message, level in messages:
+                logecho( message, level )
+            summary[outcome] += 1
+
+    except json.JSONDecodeError as e:
+        logecho(f"Error: Could not decode JSON from '{patch_file}'. Check if the file contains valid JSON.", 'error')
+        logecho( f"{e}", 'error' )
+        sys.exit(1)
+
+    logecho( "", "divider" )
+    logecho( "{restored} restored / {unchanged} unchanged / {skipped} skipped / {failed} failed / {cancelled} cancelled".format(**summary), "info" )
+    logecho( "Finished in {}s".format(round(perf_counter() - start, 2)), "info" )
 
 @twdhcli.command()
 @click.option('--new-size',
@@ -722,9 +842,36 @@ def restore_spatial(ctx, patch_file, confirm_each):
               default=False,
               is_flag=True,
               help='Don\'t prompt for snapshot, and don\'t create a snapshot')
+@click.option('--processes',
+              type=click.IntRange(min=1),
+              default=1,
+              show_default=True,
+              help='Number of processes simplifying spatial data in parallel')
+@click.option('--cache-dir',
+              type=click.Path(),
+              default='./twdh-cache/spatial-simp',
+              show_default=True,
+              help='Directory caching simplified spatial data between runs')
+@click.option('--cache-size',
+              type=click.IntRange(min=0),
+              default=1024,
+              show_default=True,
+              help='Maximum size of the cache in MB, least recently used entries are removed first')
+@click.option('--no-cache',
+              default=False,
+              is_flag=True,
+              help='Simplify everything from scratch without reading or writing the cache')
+@click.option('--journal',
+              type=click.Path(dir_okay=False),
+              default=None,
+              help='File recording the outcome of each dataset, by default a new file in ./twdh-journals')
+@click.option('--resume',
+              type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help='Journal of an interrupted run: skip the datasets it completed and append to it')
 
 @click.pass_context
-def update_spatial_simp(ctx, new_size, ids, confirm_each, allow_enlarge, skip_snapshot):
+def update_spatial_simp(ctx, new_size, ids, confirm_each, allow_enlarge, skip_snapshot, processes, cache_dir, cache_size, no_cache, journal, resume):
     """
     Update spatial_simp to new_size
     """
@@ -733,15 +880,28 @@ def update_spatial_simp(ctx, new_size, ids, confirm_each, allow_enlarge, skip_sn
     logecho = ctx.obj['logecho']
     test_run = ctx.obj['test_run']
 
-    if not skip_snapshot and click.confirm('🟢 Take a snapshot before running patches?', default=True):
-        h.snapshot( ctx, './twdh-snapshots' )
+    h.require_live(ctx)
+
+    cache = None
+    if not no_cache:
+        cache = h.SimplifyCache(cache_dir, cache_size * 1024 * 1024)
+    ctx.obj['simplify_cache'] = cache
+
+    journal = h.open_journal(ctx, 'update_spatial_simp', {'new_size': new_size, 'allow_enlarge': allow_enlarge,
+                             'ids': ids}, journal, resume)
+
+    if resume:
+        logecho( "Skipped snapshot, it was taken before the resumed run", "warning" )
+    elif not skip_snapshot and click.confirm('🟢 Take a snapshot before running patches?', default=True):
+        h.snapshot( ctx, './twdh-snapshots', incremental=True )
     else:
         logecho( "Skipped snapshot!", "warning" )
 
-    datasets = h.fetch_datasets(ctx, ids, "dataset")
+    datasets = journal.pending(h.fetch_datasets(ctx, ids, "dataset"))
 
     # Confirm patch operation
     if ids:
+        datasets = list(datasets)
         logecho( "Prepared to update spatial_simp in the following datasets", 'warning')
         for dataset in datasets:
             logecho( "- {} ({})".format(dataset.get("title"),dataset.get("id")), 'info')
@@ -753,50 +913,176 @@ def update_spatial_simp(ctx, new_size, ids, confirm_each, allow_enlarge, skip_sn
                 sys.exit(0)
     else:
         if not confirm_each:
-            if click.confirm('🟢 Proceed with updating spatial_simp on {} {}s?'.format(len(datasets), "dataset")):
+            if click.confirm('🟢 Proceed with updating spatial_simp on {} {}s?'.format(journal.pending_count(h.count_datasets(ctx, ids, "dataset")), "dataset")):
                 logecho( "Proceeding with updating spatial_simp ...", "info" )
             else: 
                 logecho( "Operation cancelled", "exit" )
                 return
 
+    if processes > 1 and confirm_each:
+        logecho( "--confirm-each updates one dataset at a time, ignoring --processes", "warning" )
+        processes = 1
+
+    try:
+        if processes > 1:
+            update_spatial_simp_in_processes(ctx, datasets, new_size, allow_enlarge, processes, journal)
+        else:
+            update_spatial_simp_serially(ctx, datasets, new_size, allow_enlarge, confirm_each, journal)
+    finally:
+        journal.close()
+
+    if cache:
+        evicted = cache.evict()
+        if evicted:
+            logecho( "Removed {} old entries from the spatial_simp cache".format(evicted), "info" )
+
+def spatial_simp_plan(dataset, new_size, allow_enlarge):
+    """
+    How update_spatial_simp treats dataset, with the spatial_simp and
+    spatial_full sizes in bytes: None when it has no spatial_full, 'keep'
+    when spatial_simp is already under new_size (unless allow_enlarge),
+    'copy' when spatial_full itself fits, otherwise 'simplify'. A missing
+    spatial_simp is always replaced.
+    """
+
+    gazetteer = dataset.get("gazetteer") or {}
+    if gazetteer.get('spatial_full') is None:
+        return None, 0, 0
+
+    spatial_simp_size = h.utf8_len(gazetteer['spatial_simp']) if gazetteer.get('spatial_simp') is not None else None
+    spatial_full_size = h.utf8_len(gazetteer['spatial_full'])
+
+    if not allow_enlarge and spatial_simp_size is not None and spatial_simp_size < new_size:
+        plan = 'keep'
+    elif spatial_full_size < new_size:
+        plan = 'copy'
+    else:
+        plan = 'simplify'
+
+    return plan, spatial_simp_size or 0, spatial_full_size
+
+def apply_simplified(ctx, dataset, plan, spatial_full_size, new_size, simplify):
+    """
+    Set spatial_simp on dataset for a 'copy' or 'simplify' plan (see
+    spatial_simp_plan), simplify() giving the simplified spatial_full, and
+    patch it if it changed. Returns the journal outcome.
+    """
+
+    logecho = ctx.obj['logecho']
+    test_run = ctx.obj['test_run']
+
+    gazetteer = dict(dataset.get("gazetteer") or {})
+    try:
+        if plan == 'copy':
+            logecho( " {} ({}) spatial_full = {} already less than {}, setting spatial_simp = spatial_full".format(dataset.get("title"),dataset.get("id"),spatial_full_size,new_size), 'info')
+            gazetteer['spatial_simp'] = gazetteer['spatial_full']
+        else:
+            gazetteer['spatial_simp'] = simplify()
+
+        changes = h.diff_changes(dataset, patch_fn_set_spatial_data(ctx,dataset,gazetteer))
+        if not changes:
+            logecho( "spatial_simp unchanged on dataset \"{}\"".format(dataset['name']), "info" )
+            return 'identical'
+        elif apply_patch(ctx,dataset,changes):
+            logecho( "Updated spatial_simp on dataset \"{}\"".format(dataset['name']), "info" )
+            return 'patched'
+        else:
+            logecho( "Error updating spatial_simp on dataset \"{}\"".format(dataset['name']), "info" )
+            return 'skipped' if test_run else 'failed'
+
+    except Exception as e:
+        logecho( e )
+        return 'failed'
+
+def update_spatial_simp_serially(ctx, datasets, new_size, allow_enlarge, confirm_each, journal):
+
+    logecho = ctx.obj['logecho']
+
     for dataset in datasets:
-        gazetteer = dataset.get("gazetteer", {})
-        if 'spatial_full' in gazetteer and gazetteer['spatial_full'] != None:
-            if not allow_enlarge and len(dataset["gazetteer"]["spatial_simp"].encode('utf-8')) < new_size:
-                logecho( "+ {} ({}) spatial_simp = {} already less than {}".format(dataset.get("title"),dataset.get("id"),len(dataset["gazetteer"]["spatial_simp"].encode('utf-8')),new_size), 'info')
+        outcome = 'unchanged'
+        plan, spatial_simp_size, spatial_full_size = spatial_simp_plan(dataset, new_size, allow_enlarge)
+        if plan:
+            if plan == 'keep':
+                logecho( "+ {} ({}) spatial_simp = {} already less than {}".format(dataset.get("title"),dataset.get("id"),spatial_simp_size,new_size), 'info')
             else:
 
-                logecho( "About to patch {} ({})".format(dataset.get("title"),dataset.get("id")), 'info')
+                logecho( "About to patch {} ({})", 'info', dataset.get("title"), dataset.get("id"))
                 if confirm_each:
                     if click.confirm('🟢 Proceed with update?'):
                         logecho( "Proceeding with update ...", "info" )
                     else: 
                         logecho( "Update cancelled", "warning" )
+                        journal.record(dataset, 'cancelled')
                         continue
-                try:
-                    if len(dataset["gazetteer"]["spatial_full"].encode('utf-8')) < new_size:
-                        logecho( " {} ({}) spatial_full = {} already less than {}, setting spatial_simp = spatial_full".format(dataset.get("title"),dataset.get("id"),len(dataset["gazetteer"]["spatial_simp"].encode('utf-8')),new_size), 'info')
-                        gazetteer['spatial_simp'] = gazetteer['spatial_full']
-                    else:
-                        #logecho( " updating {} ({})".format(dataset.get("title"),dataset.get("id")), 'info')
-                        gazetteer['spatial_simp'] = h.simplify_geojson_by_size(ctx,gazetteer['spatial_full'],new_size)
-
-                    if patch_fn_set_spatial_data(ctx,dataset,gazetteer):
-                        logecho( "Updated spatial_simp on dataset \"{}\"".format(dataset['name']), "info" )
-                    else:
-                        logecho( "Error updating spatial_simp on dataset \"{}\"".format(dataset['name']), "info" )
-                    
-
-                except Exception as e:
-                    logecho( e )
+                outcome = apply_simplified(ctx, dataset, plan, spatial_full_size, new_size,
+                                           lambda: h.simplify_geojson_by_size(ctx,dataset['gazetteer']['spatial_full'],new_size))
+
+        journal.record(dataset, outcome)
+
+def update_spatial_simp_in_processes(ctx, datasets, new_size, allow_enlarge, processes, journal):
+    """
+    update_spatial_simp with the CPU-bound simplification done by a pool of
+    processes. Their results feed a pool of threads (--concurrency) making
+    the package_patch calls, and the output is logged in dataset order.
+    """
+
+    logecho = ctx.obj['logecho']
+    concurrency = ctx.obj.get('concurrency') or h.CONCURRENCY
+    cache = ctx.obj.get('simplify_cache')
+
+    def jobs():
+        for dataset in datasets:
+            job = None
+            if spatial_simp_plan(dataset, new_size, allow_enlarge)[0] == 'simplify':
+                job = (dataset['gazetteer']['spatial_full'], new_size, cache)
+            yield dataset, job
+
+    def simplified():
+        # CPU stage: simplify_to_size on the process pool
+        for (dataset, job), future in h.bounded_map(h.simplify_job, jobs(), processes,
+                                                    arg=itemgetter(1), executor_class=ProcessPoolExecutor):
+            yield dataset, future
+
+    def update(item):
+        # I/O stage: patch on a thread, logging into a buffer
+        dataset, future = item
+        worker_ctx, messages = h.buffered_ctx(ctx)
+        logecho = worker_ctx.obj['logecho']
+
+        plan, spatial_simp_size, spatial_full_size = spatial_simp_plan(dataset, new_size, allow_enlarge)
+        if not plan:
+            return 'unchanged', messages
+
+        if plan == 'keep':
+            logecho( "+ {} ({}) spatial_simp = {} already less than {}".format(dataset.get("title"),dataset.get("id"),spatial_simp_size,new_size), 'info')
+            return 'unchanged', messages
+
+        logecho( "About to patch {} ({})", 'info', dataset.get("title"), dataset.get("id"))
+
+        def simplify():
+            spatial_simp, simplify_messages = future.result()
+            messages.extend(simplify_messages)
+            return spatial_simp
+
+        return apply_simplified(worker_ctx, dataset, plan, spatial_full_size, new_size, simplify), messages
+
+    for (dataset, simplify_future), future in h.bounded_map(update, simplified(), concurrency):
+        outcome, messages = future.result()
+        for message, level in messages:
+            logecho( message, level )
+        journal.record(dataset, outcome)
 
 @twdhcli.command()
 @click.option('--ids',
               required=False,
               default=None,
               help='list of dataset ids to show')
+@click.option('--fields',
+              required=False,
+              default=None,
+              help='Space separated list of fields to show, e.g. "name title organization". Only core fields such as name, title and state are fetched alone; any other field means whole datasets are fetched.')
 @click.pass_context
-def show_datasets(ctx,ids):
+def show_datasets(ctx,ids,fields):
     """
     Show datasets
     """
@@ -804,10 +1090,14 @@ def show_datasets(ctx,ids):
     twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
-    datasets = h.fetch_datasets(ctx, ids)
+    if fields:
+        fields = ['name'] + [field for field in fields.split() if field != 'name']
+
+    datasets = h.fetch_datasets(ctx, ids, 'dataset', fields)
 
     for dataset in datasets:
-        logecho("{}: {}".format(dataset["name"], str(dataset)), 'info')
+        logecho("{}: {}".format(dataset["name"], json.dumps(h.abridged(dataset))), 'info',
+                detail="{}: {}".format(dataset["name"], json.dumps(dataset)))
 
 
 @twdhcli.command()
@@ -815,45 +1105,46 @@ def show_datasets(ctx,ids):
               required=False,
               default=None,
               help='dataset state report')
+@click.option('--facets',
+              default='data_admin_approved state private',
+              show_default=True,
+              help='Space separated list of dataset fields to break the counts down by, e.g. "organization state"')
+@click.option('--csvout',
+              type=click.Path(),
+              default=None,
+              help='Also write the report to this CSV file.')
 @click.pass_context
-def dataset_state_report(ctx,ids):
+def dataset_state_report(ctx,ids,facets,csvout):
     """
     Print a report of dataset states
     """
 
-    twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
-    data_admin_approved = ['approved','unapproved']
-    state = ['active','draft']
-    private = ['true','false']
-
-    results = []
-    for d in data_admin_approved:
-        for s in state:
-            for p in private:
-                result = twdh.action.package_search( 
-                        fq_list=[ 
-                            'type:dataset',
-                            'data_admin_approved:{}'.format(d), 
-                            'state:{}'.format(s), 
-                            'private:{}'.format(p) 
-                        ],
-                        include_private=True,
-                        include_drafts=True
-                    ) 
-                results.append( result)
-                logecho('data_admin_approved={}/state={}/private={}: {}'.format( 
-                    d, 
-                    s, 
-                    p, 
-                    result['count'] 
-                ) )
-
-    c = 0
-    for r in results:
-        c+= r['count']
-    logecho('{} datasets'.format(c))
+    dimensions = facets.split()
+    if not dimensions:
+        raise click.BadParameter('at least one field is required', param_hint='--facets')
+
+    counts = h.facet_counts(ctx, dimensions, ids)
+
+    header = dimensions + ['count']
+    rows = [list(combination) + [count] for combination, count in counts.items()]
+
+    widths = [max(len(str(row[i])) for row in [header] + rows) for i in range(len(header))]
+    for row in [header] + rows:
+        logecho('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+    logecho('{} datasets'.format(sum(counts.values())))
+
+    if csvout:
+        try:
+            with open(csvout, 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(header)
+                writer.writerows(rows)
+        except OSError as e:
+            logecho('Unable to write CSV: {}'.format(e), 'error')
+            sys.exit(1)
 
 @twdhcli.command()
 @click.pass_context
@@ -862,19 +1153,17 @@ def get_unapproved_public_active_datasets(ctx):
     Show unapproved public active datasets
     """
 
-    twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
-    results = twdh.action.package_search(
-        fq_list=[
-            'data_admin_approved:unapproved',
-            'state:active',
-            'private:false'
-        ],
+    results = h.search_datasets(
+        ctx,
+        data_admin_approved='unapproved',
+        state='active',
+        private=False,
         rows=10000
     )
-    if results['count'] > 0:
-        for result in results['results']:
+    if results:
+        for result in results:
             logecho(result['id'], 'info')
     else:
         logecho( 'No unapproved, public, active datasets found. That\'s a good thing!', 'info' )
@@ -886,19 +1175,16 @@ def get_approved_private_draft_datasets(ctx):
     Show approved private draft datasets
     """
 
-    twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
-
-    results = twdh.action.package_search(
-        fq_list=[
-            'data_admin_approved:approved',
-            'state:draft',
-            'private:true'
-        ]
+    results = h.search_datasets(
+        ctx,
+        data_admin_approved='approved',
+        state='draft',
+        private=True
     )
-    if results['count'] > 0:
-        for result in results['results']:
+    if results:
+        for result in results:
             logecho(result['id'], 'info')
     else:
         logecho( 'No approved, private, draft datasets found. That\'s a good thing!', 'info' )
@@ -909,8 +1195,12 @@ def get_approved_private_draft_datasets(ctx):
               required=False,
               default=None,
               help='list of dataset ids to show')
+@click.option('--fields',
+              required=False,
+              default=None,
+              help='Space separated list of fields to show, e.g. "name title organization". Only core fields such as name, title and state are fetched alone; any other field means whole datasets are fetched.')
 @click.pass_context
-def show_applications(ctx,ids):
+def show_applications(ctx,ids,fields):
     """
     Show applications
     """
@@ -918,10 +1208,14 @@ def show_applications(ctx,ids):
     twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
-    datasets = h.fetch_datasets(ctx, ids, 'application')
+    if fields:
+        fields = ['name'] + [field for field in fields.split() if field != 'name']
+
+    datasets = h.fetch_datasets(ctx, ids, 'application', fields)
 
     for dataset in datasets:
-        logecho("{}: {}".format(dataset["name"], str(dataset)), 'info')
+        logecho("{}: {}".format(dataset["name"], json.dumps(h.abridged(dataset))), 'info',
+                detail="{}: {}".format(dataset["name"], json.dumps(dataset)))
 
 
 @twdhcli.command()
@@ -938,7 +1232,7 @@ def list_datasets(ctx,ids):
     twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
-    datasets = h.fetch_datasets(ctx, ids)
+    datasets = h.fetch_datasets(ctx, ids, 'dataset', h.LIST_FIELDS)
 
     for dataset in datasets:
         logecho(dataset["name"], 'info')
@@ -958,7 +1252,7 @@ def list_applications(ctx,ids):
     twdh = ctx.obj['twdh']
     logecho = ctx.obj['logecho']
 
-    datasets = h.fetch_datasets(ctx, ids, 'application')
+    datasets = h.fetch_datasets(ctx, ids, 'application', h.LIST_FIELDS)
 
     for dataset in datasets:
         logecho(dataset["name"], 'info')
@@ -978,13 +1272,17 @@ def list_applications(ctx,ids):
               default=False,
               is_flag=True,
               help='Don\t write per-dataset details to stdout')
+@click.option('--extended',
+              default=False,
+              is_flag=True,
+              help='Also parse the geometries for vertex and part counts, bounds, area, validity and simplification error, with percentiles in the summary')
 @click.pass_context
-def spatial_stats(ctx,ids,csvout,quiet):
+def spatial_stats(ctx,ids,csvout,quiet,extended):
     """
     Get spatial stats of datasets and export them to a CSV
     """
 
-    h.spatial_stats( ctx, ids, csvout, quiet )
+    h.spatial_stats( ctx, ids, csvout, quiet, extended )
 
 
 if __name__ == '__main__':